@@ -6,10 +6,101 @@ from .transform_grammar import transform_grammar
 from .sublime_generator import SublimeSyntax
 
 
-def sublime_from_cfg(text, global_args, options):
-    parser = SbnfParser(text, global_args)
-    combined_rules = parser.combined_rules
-    options = replace(options, **parser.options)
-    grammar = NonLeftRecursiveGrammar(combined_rules, start=Nonterminal('main'))
-    ss = SublimeSyntax(grammar, options)
-    return ss
+def sublime_from_cfg(text, global_args, options, jobs=1, path=None):
+    return sublime_from_cfg_variants(text, [(global_args, options)], jobs, path)[0]
+
+
+def sublime_from_cfg_variants(text, variants, jobs=1, path=None):
+    """
+    Compiles `text` once for each `(global_args, options)` pair in
+    `variants`. The text is only parsed once; actualized rules are reused
+    between variants unless they read a global arg whose value differs,
+    and variants ending up with the same rules share their analysis.
+    With `jobs` > 1, contexts are generated in that many processes.
+    `%import`s are relative to `path`, the file `text` was read from.
+    """
+    parser = SbnfParser(text, path=path)
+    grammars = []
+    syntaxes = []
+    ret = []
+    for global_args, options in variants:
+        combined_rules, parser_options = parser.make_grammar(global_args)
+        options = _with_file_options(options, parser_options)
+
+        for rules, grammar in grammars:
+            if rules == combined_rules:
+                break
+        else:
+            grammar = NonLeftRecursiveGrammar(
+                combined_rules, start=Nonterminal('main')).merge_equivalent_rules()
+            grammars.append((combined_rules, grammar))
+
+        for key, ss in syntaxes:
+            if key == (grammar, options):
+                break
+        else:
+            ss = SublimeSyntax(grammar, options, jobs=jobs)
+            syntaxes.append(((grammar, options), ss))
+        ret.append(ss)
+    return ret
+
+
+class IncrementalCompiler:
+    """
+    Compiles successive versions of the same `.sbnf` text, keeping the
+    state of the previous compile: parsed declarations, actualized rules,
+    FIRST and FOLLOW sets and generated contexts. Only the parts affected
+    by the rules that changed are recomputed.
+    """
+    def __init__(self, global_args, options, jobs=1, path=None):
+        self.global_args = global_args
+        self.options = options
+        self.jobs = jobs
+        self.path = path
+        self.parser = None
+        self.grammar = None
+        self.syntax = None
+
+    def compile(self, text):
+        if self.parser is None:
+            self.parser = SbnfParser(text, path=self.path)
+        else:
+            self.parser.update(text)
+        combined_rules, parser_options = self.parser.make_grammar(self.global_args)
+        options = _with_file_options(self.options, parser_options)
+        self.grammar = NonLeftRecursiveGrammar(
+            combined_rules, start=Nonterminal('main'),
+            previous=self.grammar).merge_equivalent_rules()
+        self.syntax = SublimeSyntax(
+            self.grammar, options, previous=self.syntax, jobs=self.jobs)
+        return self.syntax
+
+
+def _with_file_options(options, file_options):
+    """
+    `options` updated with the ones set by variables in the `.sbnf` file,
+    except for a PROFILE given by the caller (like `--profile`).
+    """
+    return replace(options, **{
+        name: value
+        for name, value in file_options.items()
+        if name != 'PROFILE' or options.PROFILE is None
+    })
+
+
+def write_if_changed(path, text):
+    """
+    Writes `text` to `path` as UTF-8 unless the file already has exactly
+    those bytes, so that build tools and Sublime don't reload syntaxes that
+    didn't change. Returns whether the file was written.
+    """
+    data = text.encode()
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, 'wb') as f:
+        f.write(data)
+    return True
@@ -1,37 +1,93 @@
 from collections import defaultdict
+from collections.abc import Mapping
 from contextlib import contextmanager
 from dataclasses import replace
-import functools
 
 from .types import Terminal, Nonterminal, Alternation
 
 
+class LazyMapping(Mapping):
+    """
+    A read-only mapping over a fixed collection of keys whose values are
+    computed on first access.
+    """
+    def __init__(self, keys, compute):
+        self._keys = keys
+        self._compute = compute
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key not in self._keys:
+                raise KeyError(key)
+            self._values[key] = self._compute(key)
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
 class NonLeftRecursiveGrammar:
-    def __init__(self, rules: dict[Nonterminal, Alternation], start: Nonterminal):
-        self.rules = rules
+    def __init__(
+        self,
+        rules: dict[Nonterminal, Alternation],
+        start: Nonterminal,
+        roots: tuple[Nonterminal] = (Nonterminal('prototype'),),
+        previous: 'NonLeftRecursiveGrammar' = None,
+    ):
+        """
+        If `previous` is the grammar for an earlier version of the same
+        rules, FIRST sets and follow set contributions are reused for
+        every symbol not affected by the rules that changed.
+        """
         self.start = start
+        self.roots = roots
+        self.symbols = self._reachable_symbols(rules, (start,) + roots)
+        self.rules = {
+            nt: alternation
+            for nt, alternation in rules.items()
+            if nt in self.symbols
+        }
         self.terminals = set([
             symbol
-            for alternation in rules.values()
+            for alternation in self.rules.values()
             for concatenation in alternation.productions
             for symbol in concatenation.concats
             if isinstance(symbol, Terminal)
         ])
+        self.referrers = self._generate_referrers()
+        changed = self.changed_symbols(previous)
         self._recursion_guard_list = []
+        self._first_sets = {}
+        if previous is None:
+            affected = self.symbols
+        else:
+            affected = self._with_referrers(changed)
+            self._first_sets.update(
+                (nt, first)
+                for nt, first in previous.first.items()
+                if nt in self.symbols and nt not in affected
+            )
         self.first = {
             nt: self._get_first_sets(nt)
-            for nt_ in self.rules
-            for nt in (nt_, Nonterminal(nt_.symbol, nt_.args, passive=True))
+            for nt in self.symbols
         }
-        self.follow = self._generate_follow_sets()
-        self.table = {
-            nt: self._generate_tables(
-                self.first[nt],
-                self.follow[nt],
+        self._follow_contributions = {}
+        if previous is not None:
+            self._follow_contributions.update(
+                (nt, contributions)
+                for nt, contributions in previous._follow_contributions.items()
+                if nt in self.rules and nt not in affected
             )
-            for nt_ in self.rules
-            for nt in (nt_, Nonterminal(nt_.symbol, nt_.args, passive=True))
-        }
+        self.follow = self._generate_follow_sets()
+        self._first_k_sets = {}
+        self.table = self._lazy_tables()
         self.sort_table = {}
         for t in self.terminals:
             if 'sort' in t.option_kv:
@@ -40,7 +96,199 @@ class NonLeftRecursiveGrammar:
                     sort_value = int(value)
                 except ValueError:
                     raise ValueError(f'"sort" option should specify an integer, found {value}')
-                self.sort_table[t.regex] = sort_value
+                # A regex given several sort values uses the smallest, so
+                # the result doesn't depend on the iteration order of
+                # `terminals`.
+                self.sort_table[t.regex] = min(
+                    sort_value, self.sort_table.get(t.regex, sort_value))
+
+    def __getstate__(self):
+        # The tables are computed by a closure, which can't be pickled.
+        state = self.__dict__.copy()
+        del state['table']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.table = self._lazy_tables()
+
+    def _lazy_tables(self):
+        return LazyMapping(
+            self.symbols,
+            lambda nt: self._generate_tables(self.first[nt], self.follow[nt]),
+        )
+
+    @staticmethod
+    def _reachable_symbols(rules, roots):
+        """
+        The nonterminals reachable from `roots`, together with the passive
+        variants that are actually referenced. Passive references and
+        `%include` prototypes make their (non-passive) rule reachable too.
+        """
+        symbols = {}
+        to_do = [nt for nt in roots if nt in rules]
+        while to_do:
+            nt = to_do.pop()
+            if nt in symbols:
+                continue
+            symbols[nt] = None
+            if nt.passive:
+                to_do.append(replace(nt, passive=False))
+                continue
+            for production in rules[nt].productions:
+                for symbol in production.concats:
+                    if isinstance(symbol, Nonterminal):
+                        to_do.append(symbol)
+                    elif symbol.include is not None:
+                        to_do.extend(symbol.include[0])
+        return symbols
+
+    def _generate_referrers(self):
+        """
+        For each symbol, the rules that refer to it (a passive symbol is
+        also referred to by its non-passive rule).
+        """
+        referrers = defaultdict(set)
+        for nt, alternation in self.rules.items():
+            for production in alternation.productions:
+                for symbol in production.concats:
+                    if isinstance(symbol, Nonterminal):
+                        referrers[symbol].add(nt)
+                        if symbol.passive:
+                            referrers[replace(symbol, passive=False)].add(symbol)
+        return referrers
+
+    def changed_symbols(self, previous):
+        """
+        The symbols that are new or whose rule differs from `previous`.
+        """
+        if previous is None:
+            return set(self.symbols)
+        changed = set(
+            nt for nt, alternation in self.rules.items()
+            if previous.rules.get(nt) != alternation
+        )
+        return set(
+            nt for nt in self.symbols
+            if nt not in previous.symbols
+            or (replace(nt, passive=False) if nt.passive else nt) in changed
+        )
+
+    def _with_referrers(self, symbols):
+        """
+        `symbols` together with every symbol that (transitively) refers to
+        one of them, i.e. everything whose FIRST set may depend on them.
+        """
+        ret = set(symbols)
+        to_do = list(symbols)
+        while to_do:
+            for referrer in self.referrers.get(to_do.pop(), ()):
+                if referrer not in ret:
+                    ret.add(referrer)
+                    to_do.append(referrer)
+        return ret
+
+    def source_rules(self, symbols):
+        """
+        The names of the `.sbnf` rules behind the rules for `symbols`. Rules
+        introduced when rewriting `?`, `*` and `(...)` are followed back to
+        the rules that use them; a rule that was inlined is reported as the
+        rules it was inlined into.
+        """
+        to_do = list(symbols)
+        seen = set()
+        ret = set()
+        while to_do:
+            nt = to_do.pop()
+            if nt in seen:
+                continue
+            seen.add(nt)
+            if nt.symbol.startswith('/'):
+                to_do.extend(self.referrers.get(nt, ()))
+                to_do.extend(self.referrers.get(replace(nt, passive=True), ()))
+            else:
+                ret.add(nt.symbol)
+        return ret
+
+    def merge_equivalent_rules(self):
+        """
+        Returns the grammar with each set of equivalent rules merged into
+        one, or this grammar if there are none. Rewriting `?`, `*` and
+        `(...)` gives every occurrence its own rule, so the same
+        subexpression in several places ends up as several identical rules.
+
+        Rules are equivalent if they have the same options and FOLLOW set,
+        and productions that only differ in referring to equivalent rules.
+        That is found by partition refinement: rules start out grouped by
+        options, FOLLOW set and number of productions, and groups are split
+        by what their productions refer to until that no longer splits
+        any. Merging such rules leaves every FIRST and FOLLOW set as it
+        was, so the generated contexts do the same thing, once.
+        """
+        fixed = {self.start, *self.roots}
+        for alternation in self.rules.values():
+            for production in alternation.productions:
+                for symbol in production.concats:
+                    if isinstance(symbol, Terminal) and symbol.include is not None:
+                        fixed.update(symbol.include[0])
+
+        def symbol_key(symbol, blocks):
+            if isinstance(symbol, Terminal):
+                return symbol
+            np_symbol = replace(symbol, passive=False) if symbol.passive else symbol
+            return blocks.get(np_symbol, np_symbol), symbol.passive
+
+        blocks = _numbered({
+            nt: (nt,) if nt in fixed else (
+                alternation.options,
+                len(alternation.productions),
+                frozenset(self.follow[nt]),
+            )
+            for nt, alternation in self.rules.items()
+        })
+        while True:
+            refined = _numbered({
+                nt: (blocks[nt], tuple(
+                    tuple(symbol_key(symbol, blocks) for symbol in production.concats)
+                    for production in alternation.productions
+                ))
+                for nt, alternation in self.rules.items()
+            })
+            if len(set(refined.values())) == len(set(blocks.values())):
+                break
+            blocks = refined
+
+        members = defaultdict(list)
+        for nt, block in blocks.items():
+            members[block].append(nt)
+        renames = {}
+        for nts in members.values():
+            # Keep the name of a rule from the `.sbnf` file if there is one.
+            keep = min(nts, key=lambda nt: (nt.symbol.startswith('/'), nt.name))
+            renames.update((nt, keep) for nt in nts if nt != keep)
+        if not renames:
+            return self
+
+        def rename(symbol):
+            if not isinstance(symbol, Nonterminal):
+                return symbol
+            np_symbol = replace(symbol, passive=False) if symbol.passive else symbol
+            if np_symbol not in renames:
+                return symbol
+            return replace(renames[np_symbol], passive=symbol.passive)
+
+        rules = {}
+        for nt, alternation in self.rules.items():
+            if nt in renames:
+                continue
+            productions = [
+                replace(production, concats=[rename(symbol) for symbol in production.concats])
+                for production in alternation.productions
+            ]
+            if productions != alternation.productions:
+                alternation = replace(alternation, productions=productions)
+            rules[nt] = alternation
+        return NonLeftRecursiveGrammar(rules, self.start, self.roots, previous=self)
 
     def _generate_tables(self, first_sets, follow_set):
         table = defaultdict(set)
@@ -86,8 +334,12 @@ class NonLeftRecursiveGrammar:
         finally:
             self._recursion_guard_list = [t for t in self._recursion_guard_list if t != symbol]
 
-    @functools.lru_cache()
     def _get_first_sets(self, symbol):
+        if symbol not in self._first_sets:
+            self._first_sets[symbol] = self._compute_first_sets(symbol)
+        return self._first_sets[symbol]
+
+    def _compute_first_sets(self, symbol):
         with self._recursion_guard(symbol):
             if isinstance(symbol, Terminal):
                 return [set([Terminal(symbol.regex, passive=symbol.passive)])]
@@ -111,38 +363,96 @@ class NonLeftRecursiveGrammar:
 
             return first_sets
 
-    def _generate_follow_sets(self):
-        nonpassive_and_passive = set(self.rules)
-        for nt in self.rules:
-            passive_nt = replace(nt, passive=True)
-            nonpassive_and_passive.add(passive_nt)
+    def first_k(self, symbols, k):
+        """
+        The sequences of up to `k` terminals that the string `symbols` can
+        start with. Sequences shorter than `k` are those of derivations that
+        end before `k` terminals, where the rest is up to what follows.
+        """
+        ret = set()
+        prefixes = {()}
+        for symbol in symbols:
+            extended = {
+                prefix + sequence
+                for prefix in prefixes
+                for sequence in self._symbol_first_k(symbol, k - len(prefix))
+            }
+            ret.update(sequence for sequence in extended if len(sequence) == k)
+            prefixes = {sequence for sequence in extended if len(sequence) < k}
+            if not prefixes:
+                break
+        return ret | prefixes
 
-        follow_sets = {nt: set() for nt in nonpassive_and_passive}
+    def _symbol_first_k(self, symbol, k):
+        if isinstance(symbol, Terminal):
+            return {(Terminal(symbol.regex, passive=symbol.passive),)}
+        if symbol.passive:
+            # Only the first terminal is searched for.
+            return {
+                (replace(sequence[0], passive=True),) + sequence[1:] if sequence else sequence
+                for sequence in self._symbol_first_k(replace(symbol, passive=False), k)
+            }
+        # The grammar isn't left-recursive, so any recursion is on a
+        # smaller `k`.
+        key = (symbol, k)
+        if key not in self._first_k_sets:
+            self._first_k_sets[key] = set().union(*(
+                self.first_k(production.concats, k)
+                for production in self.rules[symbol].productions
+            ))
+        return self._first_k_sets[key]
+
+    def _generate_follow_sets(self):
+        follow_sets = {nt: set() for nt in self.symbols}
+        if self.start in follow_sets:
+            follow_sets[self.start].add(None)
 
-        old_sum = -1
-        new_sum = 0
-        while old_sum != new_sum:
-            old_sum = new_sum
+        # The first set of whatever follows each occurrence of a nonterminal
+        # is fixed, so only occurrences whose remainder can be empty (and so
+        # inherit the follow set of the enclosing rule) need iterating.
+        occurrences = []
+        for symbol in self.rules:
+            if symbol not in self._follow_contributions:
+                self._follow_contributions[symbol] = self._follow_contribution(symbol)
+            direct, nullable = self._follow_contributions[symbol]
+            for concat, first_set in direct:
+                follow_sets[concat].update(first_set)
+            occurrences.extend((concat, symbol) for concat in nullable)
 
-            for nt in nonpassive_and_passive:
+        changed = True
+        while changed:
+            changed = False
+            for nt, symbol in occurrences:
                 follow_set = follow_sets[nt]
-                if nt == self.start:
-                    follow_set.add(None)
-                productions = [
-                    (symbol, production)
-                    for symbol, alternation in self.rules.items()
-                    for production in alternation.productions
-                    if nt in production.concats
-                ]
-                for symbol, production in productions:
-                    for i, concat in enumerate(production.concats):
-                        if concat != nt:
-                            continue
-                        remainder = production.concats[i+1:]
-                        remainder_first_set = self._get_first_set_for_string(remainder)
-                        follow_set.update(remainder_first_set.difference([None]))
-                        if None in remainder_first_set:
-                            follow_set.update(follow_sets[symbol])
-
-            new_sum = sum(len(s) for s in follow_sets.values())
+                old_len = len(follow_set)
+                follow_set.update(follow_sets[symbol])
+                changed = changed or len(follow_set) != old_len
         return follow_sets
+
+    def _follow_contribution(self, symbol):
+        """
+        What the productions of `symbol` contribute to follow sets: the
+        first set of the remainder after each nonterminal occurrence, and
+        the occurrences whose remainder can be empty.
+        """
+        direct = []
+        nullable = []
+        for production in self.rules[symbol].productions:
+            for i, concat in enumerate(production.concats):
+                if not isinstance(concat, Nonterminal):
+                    continue
+                remainder_first_set = self._get_first_set_for_string(
+                    production.concats[i+1:])
+                direct.append((concat, remainder_first_set.difference([None])))
+                if None in remainder_first_set:
+                    nullable.append(concat)
+        return direct, nullable
+
+
+def _numbered(keys):
+    """
+    Replaces the values of `keys` by numbers, equal for equal values, in
+    order of first appearance.
+    """
+    numbers = {}
+    return {k: numbers.setdefault(v, len(numbers)) for k, v in keys.items()}
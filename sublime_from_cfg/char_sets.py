@@ -0,0 +1,274 @@
+"""
+Conservative analysis of the characters terminal regexes can match. Sets of
+characters are represented as regexes matching a single character, and are
+compared by enumerating the code points they match.
+
+Patterns are parsed with Python's `re`, standing in for Oniguruma as in
+`regex_lint`. Anything `re` can't parse, or constructs whose effect on the
+first character isn't known, make the analysis give up (return None), so
+callers only act on what is known.
+"""
+from functools import lru_cache
+import re
+import warnings
+from typing import Optional
+
+try:
+    from re import _constants as c, _parser as sre_parse
+except ImportError:
+    # Before Python 3.11, which also can't parse atomic groups and
+    # possessive repeats: patterns using them are treated as unknown.
+    import sre_constants as c
+    import sre_parse
+
+ATOMIC_GROUP = getattr(c, 'ATOMIC_GROUP', None)
+POSSESSIVE_REPEAT = getattr(c, 'POSSESSIVE_REPEAT', None)
+
+
+# Oniguruma's POSIX bracket classes, which `re` doesn't support.
+_POSIX_CLASSES = {
+    '[:alnum:]': r'a-zA-Z0-9',
+    '[:alpha:]': r'a-zA-Z',
+    '[:blank:]': r' \t',
+    '[:digit:]': r'0-9',
+    '[:lower:]': r'a-z',
+    '[:punct:]': r'!-/:-@\[-`{-~',
+    '[:space:]': r'\s',
+    '[:upper:]': r'A-Z',
+    '[:word:]': r'\w',
+    '[:xdigit:]': r'0-9a-fA-F',
+}
+
+_CATEGORIES = {
+    c.CATEGORY_DIGIT: r'\d',
+    c.CATEGORY_NOT_DIGIT: r'\D',
+    c.CATEGORY_SPACE: r'\s',
+    c.CATEGORY_NOT_SPACE: r'\S',
+    c.CATEGORY_WORD: r'\w',
+    c.CATEGORY_NOT_WORD: r'\W',
+}
+
+_REPEATS = (c.MAX_REPEAT, c.MIN_REPEAT, POSSESSIVE_REPEAT)
+
+# Flags whose meaning in `re` differs from Oniguruma's, or that Oniguruma
+# doesn't have.
+_FOREIGN_FLAGS = c.SRE_FLAG_ASCII | c.SRE_FLAG_LOCALE
+
+
+def python_regex(regex):
+    """`regex` with the POSIX classes `re` doesn't know translated."""
+    for posix, translated in _POSIX_CLASSES.items():
+        regex = regex.replace(posix, translated)
+    return regex
+
+
+def parse_regex(regex):
+    """
+    Parses `regex` with `re`'s parser. Raises `re.error` if it can't, or if
+    `re` reads it differently from Oniguruma: `re` has no nested sets or
+    set operations like `[a-z&&[^aeiou]]`, and at most warns about them.
+    """
+    regex = python_regex(regex)
+    if _has_nested_set(regex):
+        raise re.error('nested set', regex)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', FutureWarning)
+        try:
+            return sre_parse.parse(regex)
+        except FutureWarning as e:
+            raise re.error(str(e), regex) from None
+
+
+def _has_nested_set(regex):
+    """Whether `regex` has an unescaped `[` inside a set."""
+    in_set = False
+    i = 0
+    while i < len(regex):
+        ch = regex[i]
+        i += 1
+        if ch == '\\':
+            i += 1
+        elif in_set:
+            if ch == '[':
+                return True
+            in_set = ch != ']'
+        elif ch == '[':
+            in_set = True
+            # A `]` first in a set is a literal.
+            if regex[i:i + 1] == '^':
+                i += 1
+            if regex[i:i + 1] == ']':
+                i += 1
+    return False
+
+
+class _Unknown(Exception):
+    pass
+
+
+def _check_flags(flags):
+    if flags & _FOREIGN_FLAGS:
+        raise _Unknown(flags)
+
+
+@lru_cache(maxsize=None)
+def first_chars(regex) -> Optional[str]:
+    """
+    A single-character regex matching at least every character a match of
+    `regex` can start at, or None if that isn't known. Regexes that can
+    match the empty string anywhere can start at any character, so for
+    them it isn't known either.
+    """
+    try:
+        tree = parse_regex(regex)
+        _check_flags(tree.state.flags)
+        items, nullable = _first(tree, bool(tree.state.flags & c.SRE_FLAG_IGNORECASE))
+    except (re.error, OverflowError, RecursionError, _Unknown):
+        return None
+    if nullable:
+        return None
+    return _union(items)
+
+
+def run_chars(regex) -> Optional[str]:
+    """
+    If `regex` greedily matches one or more characters from a single set,
+    returns that set as a single-character regex.
+    """
+    try:
+        tree = parse_regex(regex)
+        _check_flags(tree.state.flags)
+    except (re.error, OverflowError, RecursionError, _Unknown):
+        return None
+    if len(tree) != 1:
+        return None
+    op, av = tree[0]
+    if op not in (c.MAX_REPEAT, POSSESSIVE_REPEAT):
+        return None
+    lo, hi, sub = av
+    if lo < 1 or hi != c.MAXREPEAT or len(sub) != 1:
+        return None
+    item = _char_item(*sub[0])
+    if item is None:
+        return None
+    if tree.state.flags & c.SRE_FLAG_IGNORECASE:
+        item = f'(?i:{item})'
+    return _union([item])
+
+
+@lru_cache(maxsize=None)
+def disjoint(a, b):
+    """Whether the single-character regexes `a` and `b` share no character."""
+    return re.search(b, _chars(a)) is None
+
+
+_all_chars = None
+_chars_cache = {}
+
+
+def _chars(char_regex):
+    """All the characters matched by a single-character regex."""
+    global _all_chars
+    if char_regex not in _chars_cache:
+        if _all_chars is None:
+            _all_chars = ''.join(map(chr, range(0x110000)))
+        _chars_cache[char_regex] = ''.join(re.findall(char_regex, _all_chars))
+    return _chars_cache[char_regex]
+
+
+def _union(items):
+    if not items:
+        # Matches nothing.
+        return '[^\\s\\S]'
+    return '(?:' + '|'.join(dict.fromkeys(items)) + ')'
+
+
+def _escape(code):
+    return f'\\U{code:08x}'
+
+
+def _char_item(op, av):
+    if op == c.LITERAL:
+        return _escape(av)
+    if op == c.NOT_LITERAL:
+        return f'[^{_escape(av)}]'
+    if op == c.ANY:
+        return '(?s:.)'
+    if op == c.CATEGORY:
+        return _CATEGORIES.get(av)
+    if op == c.IN:
+        parts = []
+        for item_op, item_av in av:
+            if item_op == c.NEGATE:
+                parts.append('^')
+            elif item_op == c.LITERAL:
+                parts.append(_escape(item_av))
+            elif item_op == c.RANGE:
+                parts.append(f'{_escape(item_av[0])}-{_escape(item_av[1])}')
+            elif item_op == c.CATEGORY and item_av in _CATEGORIES:
+                parts.append(_CATEGORIES[item_av])
+            else:
+                return None
+        return f'[{"".join(parts)}]'
+    return None
+
+
+def _first(seq, ignore_case):
+    """
+    The single-character regexes a match of `seq` can start with, and
+    whether `seq` can match the empty string.
+    """
+    items = []
+    for op, av in seq:
+        item_items, nullable = _first_item(op, av, ignore_case)
+        items.extend(item_items)
+        if not nullable:
+            return items, False
+    return items, True
+
+
+def _first_item(op, av, ignore_case):
+    item = _char_item(op, av)
+    if item is not None:
+        return [f'(?i:{item})' if ignore_case else item], False
+    if op == c.SUBPATTERN:
+        _, add_flags, del_flags, sub = av
+        _check_flags(add_flags)
+        if add_flags & c.SRE_FLAG_IGNORECASE:
+            ignore_case = True
+        if del_flags & c.SRE_FLAG_IGNORECASE:
+            ignore_case = False
+        return _first(sub, ignore_case)
+    if op == ATOMIC_GROUP:
+        return _first(av, ignore_case)
+    if op == c.BRANCH:
+        items = []
+        nullable = False
+        for sub in av[1]:
+            sub_items, sub_nullable = _first(sub, ignore_case)
+            items.extend(sub_items)
+            nullable |= sub_nullable
+        return items, nullable
+    if op in _REPEATS:
+        lo, _, sub = av
+        items, nullable = _first(sub, ignore_case)
+        return items, nullable or lo == 0
+    if op == c.AT:
+        if av in (c.AT_END, c.AT_END_LINE):
+            # Only matches before a newline or at the end of the line.
+            return [r'\n'], False
+        if av == c.AT_END_STRING:
+            # `\Z`, which in Oniguruma also matches before a final newline.
+            raise _Unknown(av)
+        # Other anchors only restrict where a match can start.
+        return [], True
+    if op == c.ASSERT and av[0] == 1:
+        # A lookahead only matches where its pattern matches.
+        items, nullable = _first(av[1], ignore_case)
+        if not nullable:
+            return items, False
+        return [], True
+    if op in (c.ASSERT, c.ASSERT_NOT):
+        # Zero-width, and only restrict what follows.
+        return [], True
+    raise _Unknown(op)
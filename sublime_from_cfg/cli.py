@@ -1,23 +1,75 @@
 import argparse
 import os
 import re
+import shlex
+import sys
 
-from . import sublime_from_cfg
+from . import sublime_from_cfg_variants, write_if_changed
+from .report import conflict_report, footprint_report
+from .server import CompileServer
 from .types import SublimeSyntaxOptions
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        'input', help='Path to input .sbnf file')
+        'input', nargs='?', help='Path to input .sbnf file')
     parser.add_argument(
         '-o', '--output', help='Path to generated output file',
     )
+    parser.add_argument(
+        '--variant', nargs='+', action='append', metavar=('OUTPUT', 'ARG'),
+        help='Also generate OUTPUT using the given global arguments. May be '
+             'repeated; the input is only parsed once. The name of the '
+             'syntax defaults to the basename of OUTPUT.')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of processes to generate contexts in (default 1)')
+    parser.add_argument(
+        '--profile', action='append', metavar='GLOB',
+        help='Try the lookaheads that match most often in the files matched '
+             'by GLOB first, where that matches the same way. May be repeated')
+    parser.add_argument(
+        '--lint-regexes', type=int, nargs='?', const=10, metavar='N',
+        help='Print the N (default 10) terminal regexes that are most '
+             'expensive to match, with the rules they come from')
+    parser.add_argument(
+        '--conflicts', type=int, nargs='?', const=10, metavar='N',
+        help='Print the N (default 10) nonterminals with the most expensive '
+             'LL(1) conflicts, with where they are defined')
+    parser.add_argument(
+        '--footprint', type=int, nargs='?', const=10, metavar='N',
+        help='Print the N (default 10) rules whose contexts take the most '
+             'space in the output')
+    parser.add_argument(
+        '--serve', action='store_true',
+        help='Instead of compiling INPUT, serve compile requests given as '
+             'JSON lines on stdin (or on --socket); see server.py')
+    parser.add_argument(
+        '--socket', metavar='PATH',
+        help='With --serve, listen on a Unix socket at PATH')
+    parser.add_argument(
+        '--cache-size', type=int, default=16,
+        help='With --serve, number of grammars each worker keeps compiled '
+             '(default 16)')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='With --serve, number of processes to compile in (default 4)')
     parser.add_argument(
         'args', nargs='*', help='Optional global arguments')
     parser.usage = parser.format_help()
     args = parser.parse_intermixed_args()
 
+    if args.serve:
+        server = CompileServer(args.cache_size, args.workers, args.jobs)
+        if args.socket is None:
+            server.serve_stdio()
+        else:
+            server.serve_unix(args.socket)
+        return
+    if args.input is None:
+        parser.error('the following arguments are required: input')
+
     basename = re.sub(r'\.sbnf$', '', os.path.basename(args.input))
     if args.output is None:
         args.output = re.sub(r'\.sbnf$', '', args.input) + '.sublime-syntax'
@@ -25,8 +77,36 @@ def main():
     with open(args.input) as f:
         sbnf = f.read()
 
-    options = SublimeSyntaxOptions(basename)
-    ss = sublime_from_cfg(sbnf, args.args, options)
+    profile = args.profile and ' '.join(map(shlex.quote, args.profile))
+    outputs = [(args.output, args.args, SublimeSyntaxOptions(basename, PROFILE=profile))]
+    for output, *variant_args in args.variant or []:
+        name = re.sub(r'\.sublime-syntax$', '', os.path.basename(output))
+        outputs.append((output, variant_args, SublimeSyntaxOptions(name, PROFILE=profile)))
+
+    syntaxes = sublime_from_cfg_variants(
+        sbnf,
+        [(global_args, options) for _, global_args, options in outputs],
+        jobs=args.jobs,
+        path=args.input,
+    )
+
+    for (output, _, _), ss in zip(outputs, syntaxes):
+        write_if_changed(output, ss.dump())
+
+    grammars = {id(ss.grammar): ss.grammar for ss in syntaxes}
+    if args.lint_regexes is not None:
+        from .regex_lint import lint_terminals
+        for grammar in grammars.values():
+            for report in lint_terminals(grammar)[:args.lint_regexes]:
+                print(report, file=sys.stderr)
+    if args.conflicts is not None:
+        for grammar in grammars.values():
+            for report in conflict_report(grammar)[:args.conflicts]:
+                print(report, file=sys.stderr)
+    if args.footprint is not None:
+        for (output, _, _), ss in zip(outputs, syntaxes):
+            if len(syntaxes) > 1:
+                print(f'{output}:', file=sys.stderr)
+            for report in footprint_report(ss)[:args.footprint]:
+                print(report, file=sys.stderr)
 
-    with open(args.output, 'w') as f:
-        f.write(ss.dump())
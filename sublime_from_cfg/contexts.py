@@ -0,0 +1,134 @@
+"""
+A compact representation of generated contexts. A context is a tuple of
+`Match`, `Include`, `MetaScope` and `MetaIncludePrototype` records, and
+context names are interned strings. Contexts are only converted to the
+mappings and sequences that get dumped as YAML by `to_yaml`.
+"""
+import re
+import sys
+from typing import NamedTuple, Optional
+
+try:
+    import ruamel_yaml as yaml
+except ImportError:
+    from ruamel import yaml
+
+
+class Match(NamedTuple):
+    """
+    A match pattern with its scopes and action. Stacks of context names
+    (`push`, `set`, `branch`) are tuples; captures are (group, scope)
+    pairs. Fields are dumped in this order, and only if they are set.
+    """
+    match: str
+    scope: Optional[str] = None
+    captures: tuple[tuple[int, str], ...] = ()
+    embed: Optional[str] = None
+    escape: Optional[str] = None
+    embed_scope: Optional[str] = None
+    escape_captures: tuple[tuple[int, str], ...] = ()
+    branch_point: Optional[str] = None
+    branch: tuple[str, ...] = ()
+    fail: Optional[str] = None
+    push: tuple[str, ...] = ()
+    set: tuple[str, ...] = ()
+    with_prototype: tuple['Include', ...] = ()
+    pop: int = 0
+
+
+class Include(NamedTuple):
+    include: str
+
+
+class MetaScope(NamedTuple):
+    meta_scope: str
+
+
+class MetaIncludePrototype(NamedTuple):
+    meta_include_prototype: bool
+
+
+def lookahead(regex):
+    return sys.intern(f'(?={regex})')
+
+
+# A reference to a variable in a match pattern.
+_VARIABLE_REFERENCE = re.compile(r'(\{\{\w+\}\})')
+
+# Separates the match patterns while they are searched as one string.
+_SEPARATOR = '\0'
+
+
+def factor_variables(contexts, regexes):
+    """
+    Replaces the occurrences of `regexes` in the match patterns of
+    `contexts` with references to variables, wherever that makes the
+    syntax shorter. Sublime Text substitutes the variables back into the
+    patterns, so their meaning doesn't change. Longer regexes are factored
+    out first; shorter ones aren't searched for inside them. Returns the
+    variables and the new contexts.
+    """
+    patterns = _SEPARATOR.join(
+        entry.match
+        for context in contexts.values()
+        for entry in context
+        if isinstance(entry, Match)
+    )
+    variables = {}
+    for regex in sorted(set(regexes), key=lambda r: (-len(r), r)):
+        if _SEPARATOR in regex:
+            continue
+        name = f't{len(variables)}'
+        reference = f'{{{{{name}}}}}'
+        # Skip the references made so far, so they aren't split up.
+        parts = _VARIABLE_REFERENCE.split(patterns)
+        count = sum(part.count(regex) for part in parts[::2])
+        saved = count * (len(regex) - len(reference)) - len(name) - len(regex) - 4
+        if saved <= 0:
+            continue
+        parts[::2] = [part.replace(regex, reference) for part in parts[::2]]
+        patterns = ''.join(parts)
+        variables[name] = regex
+    if not variables:
+        return variables, contexts
+
+    new_patterns = iter(patterns.split(_SEPARATOR))
+    new_contexts = {
+        name: tuple(
+            entry._replace(match=sys.intern(next(new_patterns)))
+            if isinstance(entry, Match) else entry
+            for entry in context
+        )
+        for name, context in contexts.items()
+    }
+    return variables, new_contexts
+
+
+def to_yaml(contexts):
+    return {
+        name: [_entry_to_yaml(entry) for entry in context]
+        for name, context in contexts.items()
+    }
+
+
+def _entry_to_yaml(entry):
+    out = {}
+    for field, value in zip(entry._fields, entry):
+        if value is None or value == () or (field == 'pop' and value == 0):
+            continue
+        if field in ('push', 'set', 'branch'):
+            value = _flow_seq(value)
+        elif field in ('captures', 'escape_captures'):
+            value = dict(value)
+        elif field == 'with_prototype':
+            value = [_entry_to_yaml(e) for e in value]
+        out[field] = value
+    return out
+
+
+def _flow_seq(names):
+    if len(names) == 1:
+        return names[0]
+    ret = yaml.comments.CommentedSeq(names)
+    ret.fa.set_flow_style()
+    return ret
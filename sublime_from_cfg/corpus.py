@@ -0,0 +1,85 @@
+"""
+Terminal frequencies measured on a sample corpus, used to try the most
+frequent lookaheads first (see `by_frequency`).
+
+Terminals are counted by their non-empty matches anywhere in the sample
+files, with Python's `re` standing in for Oniguruma as in `regex_lint`.
+That overcounts terminals matching inside other tokens, but only the
+relative order of the counts is used.
+"""
+import glob
+import heapq
+import re
+import warnings
+
+from .char_sets import disjoint, first_chars, python_regex
+
+
+def corpus_files(patterns):
+    """The files matched by the glob `patterns`, in a fixed order."""
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern, recursive=True))
+        if not matched:
+            raise ValueError(f'No files match the profile pattern {pattern!r}')
+        paths.extend(path for path in matched if path not in paths)
+    return paths
+
+
+def terminal_frequencies(regexes, patterns):
+    """
+    The number of times each of `regexes` matches in the files matched by
+    `patterns`. Regexes `re` can't compile are counted as never matching.
+    """
+    texts = []
+    for path in corpus_files(patterns):
+        with open(path, encoding='utf-8', errors='replace') as f:
+            texts.append(f.read())
+
+    frequencies = {}
+    for regex in sorted(set(regexes)):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', FutureWarning)
+                compiled = re.compile(python_regex(regex), re.MULTILINE)
+        except (re.error, OverflowError, RecursionError):
+            frequencies[regex] = 0
+            continue
+        frequencies[regex] = sum(
+            1
+            for text in texts
+            for match in compiled.finditer(text)
+            if match.end() > match.start()
+        )
+    return frequencies
+
+
+def by_frequency(items, frequencies):
+    """
+    Reorders `items`, (regex, ...) tuples listed in order of precedence, so
+    that more frequent regexes come first. Of two regexes that can match at
+    the same place, the engine takes the one listed first, so a regex is
+    only moved past the ones it can't start at the same character as.
+    """
+    firsts = [first_chars(item[0]) for item in items]
+    # The later items each item has to stay ahead of, and the number of
+    # earlier items each item has to stay behind.
+    blocked = [[] for _ in items]
+    blockers = [0] * len(items)
+    for j in range(len(items)):
+        for i in range(j):
+            if firsts[i] is None or firsts[j] is None or not disjoint(firsts[i], firsts[j]):
+                blocked[i].append(j)
+                blockers[j] += 1
+
+    ready = [(-frequencies.get(items[i][0], 0), i) for i in range(len(items)) if not blockers[i]]
+    heapq.heapify(ready)
+    ret = []
+    while ready:
+        _, i = heapq.heappop(ready)
+        ret.append(items[i])
+        for j in blocked[i]:
+            blockers[j] -= 1
+            if not blockers[j]:
+                heapq.heappush(ready, (-frequencies.get(items[j][0], 0), j))
+    return ret
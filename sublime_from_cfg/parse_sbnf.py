@@ -1,11 +1,18 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from copy import deepcopy
 from dataclasses import fields
 from functools import partial
+import hashlib
+import os
+import pickle
 import re
-from typing import Union
+import shlex
+import threading
+from typing import NamedTuple, Union
 
+import sly
 from sly import Lexer, Parser
+from sly.lex import LexError, Token
 
 from .types import (
     Terminal,
@@ -16,6 +23,8 @@ from .types import (
     OptionalExpr,
     Passive,
     SublimeSyntaxOptions,
+    SourcePosition,
+    SourceSpan,
 )
 from .transform_grammar import transform_grammar
 
@@ -33,6 +42,175 @@ def _expand(key, context):
     return val
 
 
+class _ContextEntry:
+    """
+    A global argument or variable in the context that rules are actualized
+    in. Expanding it records that the rule being actualized depends on it.
+    """
+    def __init__(self, name, value, reads):
+        self.name = name
+        self.value = value
+        self.reads = reads
+
+    def __call__(self, **context):
+        self.reads[self.name] = self.value
+        return self.value
+
+
+def _context_value(context, name):
+    entry = context.get(name)
+    return entry.value if isinstance(entry, _ContextEntry) else entry
+
+
+_DECLARATION_TOKEN = re.compile(r"""
+    (?P<space> \s+ | \#.* )
+  | (?P<string> `[^`]*`? | '(?:\\.|[^'])*'? | \{[^}]*\}? )
+  | (?P<word> [A-Za-z0-9_\-\.]+ )
+  | (?P<punct> . )
+""", re.VERBOSE)
+
+
+def _split_declarations(text):
+    """
+    Splits sbnf source into consecutive chunks that each end with one
+    declaration: the global parameters, a variable, a rule or an import. Literals,
+    regexes, options and comments are skipped over, so that e.g. a `;`
+    inside them doesn't end a rule. Returns (chunk, line number) pairs.
+    """
+    chunks = []
+    start = 0
+    lineno = 1
+    state = None
+    for m in _DECLARATION_TOKEN.finditer(text):
+        kind, value = m.lastgroup, m.group()
+        if kind == 'space':
+            continue
+        if state is None:
+            if value == '[' and not chunks:
+                state = 'parameters'
+            elif value == '%':
+                state = 'import'
+            elif kind == 'word':
+                state = 'name'
+            else:
+                state = 'rule'
+        elif state == 'name':
+            state = 'value' if value == '=' else 'rule'
+        elif state == 'value':
+            state = 'end'
+
+        if (state == 'parameters' and value == ']') \
+                or (state == 'rule' and value == ';') \
+                or (state == 'import' and kind == 'string') \
+                or state == 'end':
+            chunk = text[start:m.end()]
+            chunks.append((chunk, lineno))
+            lineno += chunk.count('\n')
+            start = m.end()
+            state = None
+    if start < len(text):
+        chunks.append((text[start:], lineno))
+    return chunks
+
+
+# The parser turns declarations into callables that evaluate them in a
+# context of global args, variables and rule parameters. They are partials
+# of the functions below rather than closures, so that parse results can be
+# pickled and cached.
+
+def _constant(value, /, **context):
+    return value
+
+
+def _call(f, /, **context):
+    return f(**context)
+
+
+def _format_action(s, /, **context):
+    return _format(s, context)
+
+
+def _list_action(items, /, **context):
+    return [item(**context) for item in items]
+
+
+def _wrap_action(wrapper, item, /, **context):
+    return wrapper(item(**context))
+
+
+def _concatenation_action(elements, /, **context):
+    return Concatenation([element(**context) for element in elements])
+
+
+def _alternation_action(alternates, options, span, /, **context):
+    return Alternation(alternates(**context), options(**context), span)
+
+
+def _repeat_action(wrapper, item, span, /, **context):
+    return wrapper(item(**context), span)
+
+
+def _terminal_action(regex, /, **context):
+    return Terminal(regex(**context))
+
+
+def _parameter_action(name, /, **context):
+    return context.get(name, Nonterminal(name))
+
+
+def _expand_action(name, /, **context):
+    return _expand(name, context)
+
+
+def _variable_terminal_action(name, options, /, **context):
+    return Terminal(_expand(name, context), options(**context))
+
+
+def _pattern_terminal_action(regex, options, embed_include, /, **context):
+    regex_ = regex(**context)
+    options_ = options(**context)
+    kwargs = {}
+    if embed_include is not None:
+        ei, ei_args, ei_options = embed_include
+        kwargs[ei] = (tuple(ei_args(**context)), ei_options(**context))
+    return Terminal(regex_, options_, **kwargs)
+
+
+def _symbol_action(name, arguments, /, **context):
+    args = tuple([arg for arg in arguments(**context)])
+    if name in context:
+        symbol = context[name]
+        if isinstance(symbol, Terminal):
+            if len(args) > 0:
+                raise ValueError('Tried to apply args to terminal')
+            return symbol
+        name = symbol.symbol
+    return Nonterminal(name, args=args)
+
+
+def _referenced(expr):
+    """
+    The rules an actualized expression refers to, in the order they
+    appear: nonterminals and the targets of `%include`.
+    """
+    if isinstance(expr, Nonterminal):
+        yield expr
+    elif isinstance(expr, Terminal):
+        if expr.include is not None:
+            yield expr.include[0][0]
+    elif isinstance(expr, Alternation):
+        for production in expr.productions:
+            yield from _referenced(production)
+    elif isinstance(expr, Concatenation):
+        for symbol in expr.concats:
+            yield from _referenced(symbol)
+    elif isinstance(expr, (Repetition, OptionalExpr, Passive)):
+        yield from _referenced(expr.sub)
+
+
+_NONE = partial(_constant, None)
+
+
 def _format(s, context):
     class _Context(dict):
         def __getitem__(self, k):
@@ -141,19 +319,7 @@ class RegexLexer(_PrintLineNumber, Lexer):
     QUOTE = "'"
 
     def REGEX(self, t):
-        pattern = r'(\\.)|#\[([\w\-\.]+)\]'
-        def repl(m):
-            a, b = m.groups()
-            if a is not None:
-                if a == r'\'':
-                    return "'"
-                return a
-            return f'{{{b}}}'
-        t.value = re.sub(
-            pattern,
-            repl,
-            t.value.replace('{', '{{').replace('}', '}}'),
-        )
+        t.value = _regex_value(t.value)
         self.lineno += t.value.count('\n')
         return t
 
@@ -168,17 +334,7 @@ class OptionsLexer(_PrintLineNumber, Lexer):
     RBRACE = '}'
 
     def OPTIONS(self, t):
-        pattern = r'(\\.)|#\[([\w\-\.]+)\]'
-        def repl(m):
-            a, b = m.groups()
-            if a is not None:
-                return a
-            return f'{{{b}}}'
-        t.value = re.sub(
-            pattern,
-            repl,
-            t.value.replace('{', '{{').replace('}', '}}'),
-        )
+        t.value = _options_value(t.value)
         self.lineno += t.value.count('\n')
         return t
 
@@ -187,19 +343,264 @@ class OptionsLexer(_PrintLineNumber, Lexer):
         return t
 
 
+_INTERPOLATION = re.compile(r'(\\.)|#\[([\w\-\.]+)\]')
+
+
+def _regex_value(value):
+    def repl(m):
+        a, b = m.groups()
+        if a is not None:
+            if a == r'\'':
+                return "'"
+            return a
+        return f'{{{b}}}'
+    return _INTERPOLATION.sub(repl, value.replace('{', '{{').replace('}', '}}'))
+
+
+def _options_value(value):
+    def repl(m):
+        a, b = m.groups()
+        if a is not None:
+            return a
+        return f'{{{b}}}'
+    return _INTERPOLATION.sub(repl, value.replace('{', '{{').replace('}', '}}'))
+
+
+_SCAN = re.compile(r"""
+    [\ \t]+ | \#.*
+  | (?P<newline> \n+ )
+  | (?P<IDENT> [a-z0-9\-\.]+ )
+  | (?P<U_IDENT> [A-Z0-9_\.]+ )
+  | (?P<punct> <> | [=:;|~*?()}\[\],%] )
+  | ` (?P<LITERAL> [^`]* ) (?P<BTICK> `? )
+  | ' (?P<REGEX> (?:\\.|[^'])* ) (?P<QUOTE> '? )
+  | \{ (?P<OPTIONS> [^}]* ) (?P<RBRACE> \}? )
+  | (?P<error> . )
+""", re.VERBOSE)
+_PUNCT = {
+    '<>': 'EMPTY',
+    '=': 'IDENT_DEF',
+    ':': 'RULE_DEF',
+    ';': 'RULE_END',
+    '|': 'ALT',
+    '~': 'PASSIVE',
+    '*': 'STAR',
+    '?': 'QUESTION',
+    '(': 'LPAR',
+    ')': 'RPAR',
+    '}': 'RBRACE',
+    '[': 'LBRACK',
+    ']': 'RBRACK',
+    ',': 'COMMA',
+    '%': 'PERC',
+    'embed': 'EMBED',
+    'include': 'INCLUDE',
+}
+_DELIMITED = {
+    'LITERAL': ('BTICK', '`', None),
+    'REGEX': ('QUOTE', "'", _regex_value),
+    'OPTIONS': ('LBRACE', '{', _options_value),
+}
+
+
+def tokenize(text, lineno=1):
+    """
+    Produces the same tokens as `SbnfLexer().tokenize(text, lineno)`, but
+    from a single pattern instead of by switching between lexers, and
+    without the lexer's per-token overhead.
+    """
+    for m in _SCAN.finditer(text):
+        kind = m.lastgroup
+        if kind is None:
+            continue
+        index = m.start()
+        if kind == 'newline':
+            lineno += m.end() - index
+            continue
+        if kind in ('IDENT', 'U_IDENT', 'punct'):
+            tok = Token()
+            tok.value = m.group()
+            tok.type = _PUNCT.get(tok.value, 'IDENT') if kind != 'U_IDENT' else kind
+            tok.lineno = lineno
+            tok.index = index
+            tok.end = m.end()
+            yield tok
+            continue
+        if kind == 'error':
+            print(f'Error at line {lineno}')
+            raise LexError(
+                f'Illegal character {text[index]!r} at index {index}', text[index:], index)
+
+        # A literal, regex or options: the opening delimiter, the contents
+        # if not empty, and the closing delimiter unless the text ended.
+        for kind in ('LITERAL', 'REGEX', 'OPTIONS'):
+            if m.start(kind) != -1:
+                break
+        open_type, open_value, transform = _DELIMITED[kind]
+        close_type = m.lastgroup
+        tok = Token()
+        tok.type, tok.value, tok.lineno, tok.index, tok.end = \
+            open_type, open_value, lineno, index, index + 1
+        yield tok
+        start, end = m.span(kind)
+        if end > start:
+            value = m.group(kind)
+            if transform is not None:
+                value = transform(value)
+            tok = Token()
+            tok.type, tok.value, tok.lineno, tok.index, tok.end = \
+                kind, value, lineno, start, end
+            yield tok
+            lineno += value.count('\n')
+        if m.end() > end:
+            tok = Token()
+            tok.type, tok.value, tok.lineno, tok.index, tok.end = \
+                close_type, m.group(close_type), lineno, end, end + 1
+            yield tok
+
+
+def default_cache_dir():
+    """
+    Where parsed modules are cached: $SUBLIME_FROM_CFG_CACHE_DIR if set (an
+    empty value disables the disk cache), otherwise `sublime-from-cfg` in
+    the user's cache directory.
+    """
+    if 'SUBLIME_FROM_CFG_CACHE_DIR' in os.environ:
+        return os.environ['SUBLIME_FROM_CFG_CACHE_DIR'] or None
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'sublime-from-cfg')
+
+
+def _code_fingerprint():
+    # Cached parse results are only valid for the code that produced them.
+    h = hashlib.sha256(sly.__version__.encode())
+    for module in ('parse_sbnf.py', 'types.py'):
+        with open(os.path.join(os.path.dirname(__file__), module), 'rb') as f:
+            h.update(f.read())
+    return h.digest()
+
+
+class ModuleCache:
+    """
+    Parse results of imported modules by content hash, kept in memory for
+    the `size` most recently used modules and on disk in `directory`, if
+    given. Parsers in several threads may share a cache.
+    """
+    def __init__(self, directory=None, size=64):
+        self.directory = directory
+        self.size = size
+        self.modules = OrderedDict()
+        self.lock = threading.Lock()
+        self._fingerprint = None
+
+    def get(self, path, text, parse):
+        """
+        Returns `parse(text)` for the module at `path`, parsing only if it
+        isn't cached. The path is part of the key since the source spans of
+        the parsed rules refer to it.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = _code_fingerprint()
+        h = hashlib.sha256(self._fingerprint)
+        h.update(os.fsencode(path) + b'\0')
+        h.update(text.encode())
+        key = h.hexdigest()
+        with self.lock:
+            if key in self.modules:
+                self.modules.move_to_end(key)
+                return self.modules[key]
+
+        # Parsed outside the lock; two threads may both parse a module,
+        # with the same result.
+        ret = self._load(key)
+        if ret is None:
+            ret = parse(text)
+            self._store(key, ret)
+        with self.lock:
+            self.modules[key] = ret
+            while len(self.modules) > self.size:
+                self.modules.popitem(last=False)
+        return ret
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            # Missing or unreadable; parse it again.
+            return None
+
+    def _store(self, key, parsed):
+        if self.directory is None:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+
+_default_module_cache = None
+
+
+def default_module_cache():
+    global _default_module_cache
+    if _default_module_cache is None:
+        _default_module_cache = ModuleCache(default_cache_dir())
+    return _default_module_cache
+
+
+class _Declaration(NamedTuple):
+    variables: dict
+    rules: dict
+    zero_arg_rules: dict
+    global_params: list
+    imports: list
+    position: SourcePosition
+
+
 class SbnfParser(Parser):
     tokens = SbnfLexer.tokens \
            | LiteralLexer.tokens \
            | RegexLexer.tokens \
            | OptionsLexer.tokens
 
-    def __init__(self, text, global_args):
+    def __init__(self, text, global_args=None, path=None, module_cache=None):
+        """
+        `path` is where `text` was read from, which `%import`s are relative
+        to; without it they are relative to the working directory.
+        Imported modules are parsed through `module_cache`, by default one
+        shared by all parsers that caches on disk in `default_cache_dir()`.
+        """
+        self.path = path
+        self.module_cache = module_cache or default_module_cache()
         self.variables = {}
-        self.to_do = set()
         self.zero_arg_rules = {}
-        self.parameterized_rules = {}
+        self.parameterized_rules = defaultdict(dict)
         self.global_params = []
-        self.make_grammar(text, global_args)
+        self.imports = []
+        # The text of each imported module, by path.
+        self.module_texts = {}
+        self._source = None
+        # Results kept across calls to update and make_grammar, so that
+        # variants and edited versions of the same file share the work
+        # that the differences don't affect.
+        self.declarations = {}
+        self.actualized_rules = defaultdict(list)
+        self.transformed_rules = []
+        self.context_reads = {}
+        self.update(text)
+        if global_args is not None:
+            self.combined_rules, self.options = self.make_grammar(global_args)
 
 
     @_('[ parameters ] { variable_or_rule }')
@@ -209,103 +610,94 @@ class SbnfParser(Parser):
                 self.global_params.append(nt.symbol)
         return p
 
-    @_('variable', 'rule')
+    @_('variable', 'rule', 'module_import')
     def variable_or_rule(self, p):
         return p
 
+    @_('PERC IDENT BTICK [ LITERAL ] BTICK')
+    def module_import(self, p):
+        if p.IDENT != 'import':
+            raise ValueError(f'Unknown directive %{p.IDENT} at line {p.lineno}')
+        self.imports.append((p.LITERAL or '', p.lineno))
+        return p
+
     @_('U_IDENT IDENT_DEF variable_defn')
     def variable(self, p):
-        var_defn = p.variable_defn
-        self.variables[p.U_IDENT] = lambda **context: var_defn(**context)
+        self.variables[p.U_IDENT] = partial(_call, p.variable_defn)
         return p
 
     @_('literal_or_regex')
     def variable_defn(self, p):
-        p0 = p[0]
-        return lambda **context: p0(**context)
+        return p[0]
 
     @_('U_IDENT')
     def variable_defn(self, p):
-        p0 = p[0]
-        return p0 # lambda **context: self.variables[p0](**context)
+        return p[0]
 
     @_('IDENT [ parameters ] [ options ] RULE_DEF alternates RULE_END')
     def rule(self, p):
-        alternates = p.alternates
-        options = (lambda **context: None) if p.options is None else p.options
-        parameters = (lambda **context: tuple()) if p.parameters is None else p.parameters
-        def ret(**context):
-            return Alternation(alternates(**context), options(**context))
-        self.parameterized_rules[(p.IDENT, tuple(parameters()))] = ret
+        options = _NONE if p.options is None else p.options
+        parameters = () if p.parameters is None else p.parameters()
+        ret = partial(_alternation_action, p.alternates, options, self._span(p))
+        self.parameterized_rules[p.IDENT][tuple(parameters)] = ret
         if p.parameters is None:
-            self.zero_arg_rules[p.IDENT] = lambda **context: Nonterminal(p.IDENT)
+            self.zero_arg_rules[p.IDENT] = Nonterminal(p.IDENT)
         return p
 
     @_('LBRACK parameter { COMMA parameter } RBRACK')
     def parameters(self, p):
-        params = [p.parameter0] + p.parameter1
-        return lambda **context: [param(**context) for param in params]
+        return partial(_list_action, [p.parameter0] + p.parameter1)
 
     @_('LBRACK argument { COMMA argument } RBRACK')
     def arguments(self, p):
-        arguments = [p.argument0] + p.argument1
-        return lambda **context: [arg(**context) for arg in arguments]
+        return partial(_list_action, [p.argument0] + p.argument1)
 
     @_('literal_or_regex')
     def parameter(self, p):
-        lit_or_reg = p.literal_or_regex
-        return lambda **context: Terminal(lit_or_reg(**context))
+        return partial(_terminal_action, p.literal_or_regex)
 
     @_('IDENT')
     def parameter(self, p):
-        IDENT = p.IDENT
-        return lambda **context: Nonterminal(IDENT)
+        return partial(_constant, Nonterminal(p.IDENT))
 
     @_('U_IDENT')
     def parameter(self, p):
-        U_IDENT = p.U_IDENT
-        return lambda **context: context.get(U_IDENT, Nonterminal(U_IDENT))
+        return partial(_parameter_action, p.U_IDENT)
 
     @_('literal_or_regex')
     def argument(self, p):
-        lit_or_reg = p.literal_or_regex
-        return lambda **context: Terminal(lit_or_reg(**context))
+        return partial(_terminal_action, p.literal_or_regex)
 
     @_('IDENT')
     def argument(self, p):
-        IDENT = p.IDENT
-        return lambda **context: Nonterminal(IDENT)
+        return partial(_constant, Nonterminal(p.IDENT))
 
     @_('U_IDENT')
     def argument(self, p):
-        U_IDENT = p.U_IDENT
-        return lambda **context: _expand(U_IDENT, context)
+        return partial(_expand_action, p.U_IDENT)
 
     @_('production { ALT production }')
     def alternates(self, p):
-        productions = [p.production0] + p.production1
-        return lambda **context: [prod(**context) for prod in productions]
+        return partial(_list_action, [p.production0] + p.production1)
 
     @_('pattern_element { pattern_element }')
     def production(self, p):
-        elements = [p.pattern_element0] + p.pattern_element1
-        return lambda **context: Concatenation([element(**context) for element in elements])
+        return partial(_concatenation_action, [p.pattern_element0] + p.pattern_element1)
 
     @_('EMPTY')
     def production(self, p):
-        return lambda **context: Concatenation([])
+        return partial(_concatenation_action, [])
 
     @_('[ PASSIVE ] pattern_item [ star_or_question ]')
     def pattern_element(self, p):
-        pattern_item = p.pattern_item
-        ret = lambda **context: pattern_item(**context)
+        ret = p.pattern_item
 
         if p.star_or_question is not None:
             op = Repetition if p.star_or_question == '*' else OptionalExpr
-            ret = partial((lambda r, **context: op(r(**context))), ret)
+            ret = partial(_repeat_action, op, ret, self._span(p))
 
         if p.PASSIVE is not None:
-            ret = partial((lambda r, **context: Passive(r(**context))), ret)
+            ret = partial(_wrap_action, Passive, ret)
 
         return ret
 
@@ -315,62 +707,27 @@ class SbnfParser(Parser):
 
     @_('literal_or_regex [ options ] [ embed_include ]')
     def pattern_item(self, p):
-        lit_or_reg = p.literal_or_regex
-        options = (lambda **context: None) if p.options is None else p.options
-        embed_include = p.embed_include
-        if embed_include is not None:
-            ei, ei_args, ei_options = p.embed_include
-            ei_kwarg = lambda **context: {ei: (tuple(ei_args(**context)), ei_options(**context))}
-        else:
-            ei_kwarg = lambda **context: {}
-        def make_terminal(**context):
-            regex = lit_or_reg(**context)
-            options_ = options(**context)
-            ei_kwarg_ = ei_kwarg(**context)
-            if ei_kwarg:
-                if 'include' in ei_kwarg_:
-                    new_nt = ei_kwarg_['include'][0][0]
-                    self.to_do.add(new_nt)
-            return Terminal(
-                regex,
-                options_,
-                **ei_kwarg_
-            )
-        return make_terminal
+        options = _NONE if p.options is None else p.options
+        return partial(_pattern_terminal_action, p.literal_or_regex, options, p.embed_include)
 
     @_('LPAR alternates RPAR')
     def pattern_item(self, p):
-        alternates = p.alternates
-        return lambda **context: Alternation(alternates(**context))
+        return partial(_alternation_action, p.alternates, _NONE, self._span(p))
 
     @_('IDENT [ arguments ]')
     def pattern_item(self, p):
-        arguments = p.arguments or (lambda **context: [])
-        IDENT = p.IDENT
-        def make_symbol(i, **context):
-            args = tuple([arg for arg in arguments(**context)])
-            if i in context:
-                symbol = context[i]
-                if isinstance(symbol, Terminal):
-                    if len(args) > 0:
-                        raise ValueError('Tried to apply args to terminal')
-                    return symbol
-                i = symbol.symbol
-            nt = Nonterminal(i, args=args)
-            self.to_do.add(nt)
-            return nt
-        return partial(make_symbol, IDENT)
+        arguments = p.arguments or partial(_constant, [])
+        return partial(_symbol_action, p.IDENT, arguments)
 
     @_('U_IDENT [ options ]')
     def pattern_item(self, p):
-        U_IDENT = p.U_IDENT
-        options = p.options or (lambda **context: None)
-        return lambda **context: Terminal(_expand(U_IDENT, context), options(**context))
+        options = p.options or _NONE
+        return partial(_variable_terminal_action, p.U_IDENT, options)
 
     @_('LBRACE [ OPTIONS ] RBRACE')
     def options(self, p):
         OPTIONS = p.OPTIONS if p.OPTIONS is not None else ''
-        return lambda **context: _format(OPTIONS, context)
+        return partial(_format_action, OPTIONS)
 
     @_('PERC embed_or_include_token arguments options')
     def embed_include(self, p):
@@ -387,22 +744,20 @@ class SbnfParser(Parser):
     @_('QUOTE [ REGEX ] QUOTE')
     def regex(self, p):
         reg = p.REGEX if p.REGEX is not None else ''
-        return lambda **context: _format(reg, context)
+        return partial(_format_action, reg)
 
     @_('BTICK [ LITERAL ] BTICK')
     def literal(self, p):
         LITERAL = p.LITERAL if p.LITERAL is not None else ''
         as_regex = re.escape(LITERAL).replace('{', '{{').replace('}', '}}')
-        return lambda **context: _format(as_regex, context)
+        return partial(_format_action, as_regex)
 
     def error(self, token):
         super().error(token)
         raise ValueError('Syntax error; aborting.')
 
     def find_matching_rule(self, name, args):
-        for (ident, params), rule in self.parameterized_rules.items():
-            if name != ident:
-                continue
+        for params, rule in self.parameterized_rules.get(name, {}).items():
             if len(args) != len(params):
                 continue
             match = True
@@ -423,40 +778,192 @@ class SbnfParser(Parser):
                 return rule, rule_context
         raise ValueError(f'No matching rule found for {name}, {args}')
 
+    def update(self, text):
+        """
+        Parses `text`, which may be an edited version of the text parsed
+        before. Only declarations whose text changed are parsed again, and
+        actualized rules are dropped if the definitions they were
+        actualized from changed.
+        """
+        declarations = {}
+        parsed = []
+        for chunk, lineno in _split_declarations(text):
+            if chunk not in declarations:
+                declaration = self.declarations.get(chunk)
+                if declaration is None:
+                    declaration = self.parse_declaration(chunk, lineno, self.path)
+                else:
+                    # Unchanged, but edits above it may have moved it.
+                    declaration.position.lineno = lineno
+                declarations[chunk] = declaration
+            parsed.append(declarations[chunk])
+        main_path = os.path.abspath(self.path or 'main.sbnf')
+        # A module importing the main file doesn't import it again.
+        imported = {os.path.normpath(main_path)} if self.path else set()
+        self.module_texts = {}
+        parsed = list(self._with_imports(parsed, os.path.dirname(main_path), imported))
+
+        variables = {}
+        parameterized_rules = defaultdict(dict)
+        zero_arg_rules = {}
+        global_params = []
+        for declaration in parsed:
+            variables.update(declaration.variables)
+            for name, rules in declaration.rules.items():
+                parameterized_rules[name].update(rules)
+            zero_arg_rules.update(declaration.zero_arg_rules)
+            global_params.extend(declaration.global_params)
+
+        # Definitions are matched in order, so compare them in order too.
+        changed = set(
+            name for name in parameterized_rules.keys() | self.parameterized_rules.keys()
+            if list(parameterized_rules.get(name, {}).items())
+                != list(self.parameterized_rules.get(name, {}).items())
+        )
+        zero_arg_changed = zero_arg_rules.keys() != self.zero_arg_rules.keys()
+        for nt in list(self.actualized_rules):
+            if nt.symbol in changed or (nt.args and zero_arg_changed):
+                del self.actualized_rules[nt]
+        self.transformed_rules.clear()
+
+        self.declarations = declarations
+        self.variables = variables
+        self.parameterized_rules = parameterized_rules
+        self.zero_arg_rules = zero_arg_rules
+        self.global_params = global_params
+
+    def parse_declaration(self, text, lineno=1, path=None):
+        """
+        Parses a chunk of source on its own, which starts at line `lineno`
+        of the file at `path`.
+        """
+        outer = (self.variables, self.parameterized_rules, self.zero_arg_rules,
+                 self.global_params, self.imports, self._source)
+        self.variables = {}
+        self.parameterized_rules = defaultdict(dict)
+        self.zero_arg_rules = {}
+        self.global_params = []
+        self.imports = []
+        self._source = (text, SourcePosition(path, lineno))
+        try:
+            self.parse(tokenize(text, lineno=lineno))
+            return _Declaration(
+                self.variables, self.parameterized_rules, self.zero_arg_rules,
+                self.global_params, self.imports, self._source[1])
+        finally:
+            (self.variables, self.parameterized_rules, self.zero_arg_rules,
+             self.global_params, self.imports, self._source) = outer
+
+    def _span(self, p):
+        """The lines spanned by the production being reduced."""
+        text, position = self._source
+        return SourceSpan(position, text.count('\n', 0, p.index), text.count('\n', 0, p.end))
+
+    def parse_module(self, text, path):
+        """Parses the declarations of an imported module."""
+        return [
+            self.parse_declaration(chunk, lineno, path)
+            for chunk, lineno in _split_declarations(text)
+        ]
+
+    def _with_imports(self, parsed, directory, imported):
+        """
+        Yields the parsed declarations, each followed by those of the
+        modules it imports. A module is only imported once, however many
+        times it is imported.
+        """
+        for declaration in parsed:
+            yield declaration
+            for name, lineno in declaration.imports:
+                path = os.path.normpath(os.path.join(directory, name))
+                if path in imported:
+                    continue
+                imported.add(path)
+                try:
+                    with open(path) as f:
+                        text = f.read()
+                except OSError as e:
+                    where = f'line {lineno}'
+                    if declaration.position.path is not None:
+                        where += f' of {declaration.position.path}'
+                    raise ValueError(
+                        f'Can\'t import {path} at {where}: {e.strerror}') from e
+                self.module_texts[path] = text
+                try:
+                    module = self.module_cache.get(
+                        path, text, partial(self.parse_module, path=path))
+                except ValueError as e:
+                    raise ValueError(f'In module {path}: {e}') from e
+                if any(declaration.global_params for declaration in module):
+                    raise ValueError(f'Module {path} can\'t declare global parameters')
+                yield from self._with_imports(module, os.path.dirname(path), imported)
+
     def make_actualized_rules(self, start, context):
-        self.to_do.add(start)
+        to_do = [start]
         actual_rules = {}
-        while self.to_do:
-            to_do, self.to_do = self.to_do, set()
-            for nt in to_do:
+        while to_do:
+            batch, to_do = to_do, []
+            for nt in batch:
                 if nt in actual_rules:
                     continue
-                name = nt.symbol
-                args = nt.args
-                rule, rule_context = self.find_matching_rule(name, args)
-                new_context = {**context, **rule_context}
-                actual_rules[nt] = rule(**new_context)
+                actual_rules[nt], referenced = self.actualize_rule(nt, context)
+                to_do.extend(referenced)
         return actual_rules
 
-    def make_grammar(self, text, global_args):
-        lexer = SbnfLexer()
-        self.parse(lexer.tokenize(text))
+    def actualize_rule(self, nt, context):
+        """
+        Returns the actualized rule for `nt` together with the symbols it
+        references. A rule actualized before is reused if the global args
+        and variables it read have the same values in `context`.
+        """
+        for reads, alternation, referenced in self.actualized_rules[nt]:
+            if all(_context_value(context, name) == value for name, value in reads):
+                return alternation, referenced
+
+        rule, rule_context = self.find_matching_rule(nt.symbol, nt.args)
+        self.context_reads.clear()
+        alternation = rule(**{**context, **rule_context})
+        referenced = list(_referenced(alternation))
+        reads = tuple(self.context_reads.items())
+        self.actualized_rules[nt].append((reads, alternation, referenced))
+        return alternation, referenced
+
+    def transform_rules(self, actual_rules):
+        for previous, transformed in self.transformed_rules:
+            if previous == actual_rules:
+                return transformed
+        transformed = transform_grammar(actual_rules)
+        self.transformed_rules.append((actual_rules, transformed))
+        return transformed
+
+    def make_grammar(self, global_args):
+        """
+        Actualizes and transforms the parsed rules for one set of global
+        args. Returns the combined rules and the options set by variables.
+        """
         context = {}
         for param, arg in zip(self.global_params, global_args):
-            context[param] = arg
-        context.update(self.variables)
+            context[param] = _ContextEntry(param, arg, self.context_reads)
+        for name, variable in self.variables.items():
+            context[name] = _ContextEntry(name, variable, self.context_reads)
         main_rules = self.make_actualized_rules(Nonterminal('main'), context)
-        main_rules = transform_grammar(main_rules)
+        main_rules = self.transform_rules(main_rules)
 
-        if ('prototype', tuple()) in self.parameterized_rules:
+        if tuple() in self.parameterized_rules.get('prototype', {}):
             proto_rules = self.make_actualized_rules(Nonterminal('prototype'), context)
-            proto_rules = transform_grammar(proto_rules)
+            proto_rules = self.transform_rules(proto_rules)
         else:
             proto_rules = {}
 
-        self.options = {}
+        options = {}
         for field in fields(SublimeSyntaxOptions):
             if field.name in self.variables:
-                self.options[field.name] = _expand(field.name, context)
-
-        self.combined_rules = {**main_rules, **proto_rules}
+                options[field.name] = _expand(field.name, context)
+        if 'PROFILE' in options and self.path:
+            # Patterns in the file are relative to it.
+            directory = os.path.dirname(self.path)
+            options['PROFILE'] = ' '.join(
+                shlex.quote(os.path.join(directory, pattern))
+                for pattern in shlex.split(options['PROFILE']))
+
+        return {**main_rules, **proto_rules}, options
@@ -0,0 +1,508 @@
+"""
+Finds terminal regexes that are expensive to match. Sublime's regex engines
+backtrack, so a pattern that can match the same text in many ways can take
+super-linear time on a long line. Each regex of a grammar is checked
+statically for such constructs, then timed against generated inputs that
+reach a repeat, pump its body and end in a failing character. A search
+taking longer than a hard timeout is stopped, so that a truly exponential
+pattern can't hang the linter.
+
+Patterns are parsed and timed with Python's `re`, which backtracks like
+Oniguruma. Regexes using syntax `re` doesn't know are reported as skipped.
+"""
+from collections import defaultdict
+from dataclasses import dataclass, field
+import multiprocessing
+import re
+import signal
+import string
+import threading
+import time
+import warnings
+from typing import Optional
+
+from .char_sets import ATOMIC_GROUP, POSSESSIVE_REPEAT, c, python_regex, sre_parse
+from .types import Terminal
+
+
+_ALPHABET = frozenset(string.printable + 'éλ')
+_UNBOUNDED = c.MAXREPEAT
+_FAIL_CHARS = '\x00!#~'
+_MAX_PUMPS = 16
+
+
+@dataclass
+class RegexReport:
+    regex: str
+    rules: list[str]
+    issues: list[str] = field(default_factory=list)
+    # Length of the longest generated input searched within the budget, the
+    # time it took and the input that was used.
+    length: int = 0
+    seconds: float = 0.0
+    input: str = ''
+    over_budget: bool = False
+    error: Optional[str] = None
+
+    def __str__(self):
+        rules = ', '.join(self.rules)
+        if self.error is not None:
+            return f'{self.regex!r} ({rules}): skipped, {self.error}'
+        if self.over_budget:
+            timing = f'over budget on {self.length} characters'
+        else:
+            timing = f'{self.seconds * 1000:.1f}ms on {self.length} characters'
+        lines = [f'{self.regex!r} ({rules}): {timing}']
+        lines.extend(f'    {issue}' for issue in self.issues)
+        return '\n'.join(lines)
+
+
+def lint_terminals(grammar, max_length=2000, budget=0.05, timeout=1.0):
+    """
+    Returns a report for each terminal regex in `grammar`, worst first.
+    Each regex is searched in generated lines of increasing length up to
+    `max_length`, stopping early once one takes longer than `budget`
+    seconds. A single search is stopped after `timeout` seconds.
+    """
+    used_in = defaultdict(set)
+    for nt, alternation in grammar.rules.items():
+        for production in alternation.productions:
+            for symbol in production.concats:
+                if isinstance(symbol, Terminal):
+                    used_in[symbol.regex].add(nt)
+    reports = {}
+    for t in grammar.terminals:
+        if t.regex not in reports:
+            rules = grammar.source_rules(used_in[t.regex])
+            reports[t.regex] = RegexReport(t.regex, sorted(rules))
+    searcher = _Searcher(timeout)
+    try:
+        for report in reports.values():
+            _lint_regex(report, max_length, budget, searcher)
+    finally:
+        searcher.close()
+    return sorted(reports.values(), key=_badness)
+
+
+def _badness(report):
+    # Over budget first, then regexes with static issues, then the slowest.
+    # Regexes that couldn't be checked go last.
+    if report.error is not None:
+        return (3, 0, report.regex)
+    if report.over_budget:
+        return (0, report.length, report.regex)
+    return (1 if report.issues else 2, -report.seconds, report.regex)
+
+
+def _lint_regex(report, max_length, budget, searcher):
+    regex = python_regex(report.regex)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            tree = sre_parse.parse(regex)
+            compiled = re.compile(regex)
+    except (re.error, OverflowError, RecursionError) as e:
+        report.error = f'can\'t parse with Python\'s re: {e}'
+        return
+    report.issues = list(dict.fromkeys(_issues(tree)))
+
+    chars = _chars(tree)
+    fail = next((ch for ch in _FAIL_CHARS if ch not in chars), '\x00')
+    for prefix, pump in _pumps(tree):
+        length, seconds, line, over = _time(
+            searcher, compiled, prefix, pump, fail, max_length, budget)
+        if _cost(over, length, seconds) > _cost(report.over_budget, report.length, report.seconds):
+            report.length, report.seconds, report.input, report.over_budget = \
+                length, seconds, line, over
+
+
+def _cost(over_budget, length, seconds):
+    return (1, -length) if over_budget else (0, seconds)
+
+
+def _time(searcher, compiled, prefix, pump, fail, max_length, budget):
+    """
+    Searches lines of `prefix`, then `pump` repeated and followed by
+    `fail`. The number of repetitions grows by one while it is small, so
+    that exponential patterns are stopped soon after they exceed the
+    budget, then geometrically.
+    """
+    count = 1
+    while True:
+        line = prefix + (pump * count)[:max_length - 2 - len(prefix)] + fail + '\n'
+        seconds = searcher.search(compiled, line)
+        if seconds is None:
+            return len(line), searcher.timeout, line, True
+        if seconds > budget:
+            return len(line), seconds, line, True
+        if len(line) >= max_length:
+            return len(line), seconds, line, False
+        count = count + 1 if count < 24 else count * 3 // 2
+
+
+class _Timeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise _Timeout
+
+
+def _timed_search(regex, line):
+    compiled = re.compile(regex)
+    start = time.perf_counter()
+    compiled.search(line)
+    return time.perf_counter() - start
+
+
+class _Searcher:
+    """
+    Times searches, giving up on any that takes longer than `timeout`
+    seconds. Searches are interrupted by SIGALRM where that is available
+    (on the main thread, on Unix), and otherwise run in a separate process
+    that is killed on a timeout.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.use_alarm = hasattr(signal, 'setitimer') \
+            and threading.current_thread() is threading.main_thread()
+        self.pool = None
+
+    def search(self, compiled, line):
+        """The seconds searching `line` took, or None on a timeout."""
+        if self.use_alarm:
+            previous = signal.signal(signal.SIGALRM, _raise_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self.timeout)
+            try:
+                start = time.perf_counter()
+                compiled.search(line)
+                return time.perf_counter() - start
+            except _Timeout:
+                return None
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous)
+
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(1)
+        result = self.pool.apply_async(_timed_search, (compiled.pattern, line))
+        try:
+            return result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            self.close()
+            return None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+# ---
+
+
+def _issues(items):
+    """Yields descriptions of the super-linear constructs in a parsed regex."""
+    items = list(items)
+    for i, (op, av) in enumerate(items):
+        if op in (c.MAX_REPEAT, c.MIN_REPEAT):
+            low, high, body = av
+            if high == _UNBOUNDED or high > 1:
+                yield from _repeat_issues(list(body))
+            yield from _issues(body)
+            if high == _UNBOUNDED:
+                yield from _adjacent_issues(items, i)
+        elif op == POSSESSIVE_REPEAT:
+            continue
+        elif op == ATOMIC_GROUP:
+            continue
+        elif op == c.SUBPATTERN:
+            yield from _issues(av[-1])
+        elif op == c.BRANCH:
+            for alt in av[1]:
+                yield from _issues(alt)
+        elif op == c.ASSERT or op == c.ASSERT_NOT:
+            yield from _issues(av[1])
+        elif op == c.GROUPREF_EXISTS:
+            for alt in av[1:]:
+                if alt is not None:
+                    yield from _issues(alt)
+
+
+def _repeat_issues(body):
+    """Ways the body of a repeat can match the same text more than once."""
+    items = list(_flatten(body))
+    required = [item for item in items if not _nullable([item])]
+    for item in items:
+        op, av = item
+        if op in (c.MAX_REPEAT, c.MIN_REPEAT) and av[1] == _UNBOUNDED:
+            inner = _chars(av[2])
+            others = [r for r in required if r is not item]
+            if all(_chars([r]) & inner for r in others):
+                yield f'nested quantifier: {_show(body)} repeats {_show([item])}'
+        if op == c.BRANCH:
+            # `re` factors out a prefix the alternatives share, turning
+            # `a|ab` into `a(?:|b)`: an alternative that can be empty is
+            # what is left of such an overlap.
+            firsts = [_first(alt) for alt in av[1]]
+            nullable = [_nullable(alt) for alt in av[1]]
+            if any(nullable) or any(
+                a & b for j, a in enumerate(firsts) for b in firsts[j + 1:]
+            ):
+                yield f'overlapping alternatives under a quantifier: {_show(body)}'
+
+
+def _flatten(items):
+    """The items of a sequence, looking into groups that are matched once."""
+    for item in items:
+        op, av = item
+        if op == c.SUBPATTERN:
+            yield from _flatten(av[-1])
+        else:
+            yield item
+
+
+def _adjacent_issues(items, i):
+    """
+    An unbounded repeat followed (possibly after optional items) by another
+    one that can consume the same characters: every split point between the
+    two is tried before failing.
+    """
+    chars = _chars([items[i]])
+    for op, av in items[i + 1:]:
+        if op in (c.MAX_REPEAT, c.MIN_REPEAT) and av[1] == _UNBOUNDED \
+                and chars & _chars(av[2]):
+            yield f'adjacent quantifiers can match the same text: {_show(items[i:i + 1])} and {_show([(op, av)])}'
+            return
+        if not _nullable([(op, av)]):
+            return
+
+
+def _nullable(items):
+    for op, av in items:
+        if op in (c.MAX_REPEAT, c.MIN_REPEAT, POSSESSIVE_REPEAT):
+            if av[0] > 0 and not _nullable(av[2]):
+                return False
+        elif op in (c.SUBPATTERN, ATOMIC_GROUP):
+            if not _nullable(av[-1] if op == c.SUBPATTERN else av):
+                return False
+        elif op == c.BRANCH:
+            if not any(_nullable(alt) for alt in av[1]):
+                return False
+        elif op in (c.AT, c.ASSERT, c.ASSERT_NOT, c.GROUPREF_EXISTS):
+            continue
+        else:
+            return False
+    return True
+
+
+def _first(items):
+    """Characters (of a sample alphabet) a match of `items` can start with."""
+    ret = set()
+    for item in items:
+        ret |= _chars([item]) if item[0] not in (c.SUBPATTERN, c.BRANCH) else _first_of(item)
+        if not _nullable([item]):
+            break
+    return ret
+
+
+def _first_of(item):
+    op, av = item
+    if op == c.SUBPATTERN:
+        return _first(av[-1])
+    return set().union(*(_first(alt) for alt in av[1]))
+
+
+def _chars(items):
+    """Characters (of a sample alphabet) a match of `items` can contain."""
+    ret = set()
+    for op, av in items:
+        if op == c.LITERAL:
+            ret.add(chr(av))
+        elif op == c.NOT_LITERAL:
+            ret |= _ALPHABET - {chr(av)}
+        elif op == c.ANY:
+            ret |= _ALPHABET - {'\n'}
+        elif op == c.IN:
+            ret |= _in_chars(av)
+        elif op in (c.MAX_REPEAT, c.MIN_REPEAT, POSSESSIVE_REPEAT):
+            ret |= _chars(av[2])
+        elif op == c.SUBPATTERN:
+            ret |= _chars(av[-1])
+        elif op == ATOMIC_GROUP:
+            ret |= _chars(av)
+        elif op == c.BRANCH:
+            for alt in av[1]:
+                ret |= _chars(alt)
+        elif op == c.GROUPREF_EXISTS:
+            for alt in av[1:]:
+                if alt is not None:
+                    ret |= _chars(alt)
+        elif op == c.GROUPREF:
+            ret |= _ALPHABET
+    return ret
+
+
+_CATEGORIES = {
+    'CATEGORY_DIGIT': str.isdigit,
+    'CATEGORY_SPACE': str.isspace,
+    'CATEGORY_WORD': lambda ch: ch.isalnum() or ch == '_',
+}
+
+
+def _in_chars(items):
+    ret = set()
+    negate = False
+    for op, av in items:
+        if op == c.NEGATE:
+            negate = True
+        elif op == c.LITERAL:
+            ret.add(chr(av))
+        elif op == c.RANGE:
+            ret |= {ch for ch in _ALPHABET if av[0] <= ord(ch) <= av[1]}
+            ret |= {chr(av[0]), chr(av[1])}
+        elif op == c.CATEGORY:
+            test = _CATEGORIES.get(str(av).replace('NOT_', ''), lambda ch: True)
+            matching = {ch for ch in _ALPHABET if test(ch)}
+            ret |= _ALPHABET - matching if 'NOT_' in str(av) else matching
+    return _ALPHABET - ret if negate else ret
+
+
+def _pumps(items):
+    """
+    Inputs worth repeating to attack a regex, as (prefix, pump) pairs: a
+    sample match of the body of every repeat, and a sample character of
+    every character class that is repeated, each after a sample match of
+    what comes before the repeat so that the search gets to it. Only
+    repeats can make the work super-linear; a regex without any is pumped
+    with a sample match of itself.
+    """
+    pumps = [
+        (prefix, pump)
+        for prefix, pump in dict.fromkeys(_repeat_pumps(items, ''))
+        if pump and pump != '\n'
+    ][:_MAX_PUMPS]
+    return pumps or [('', _sample(items) or 'a')]
+
+
+def _repeat_pumps(items, prefix):
+    for i, (op, av) in enumerate(items):
+        before = prefix + _sample(items[:i])
+        if op in (c.MAX_REPEAT, c.MIN_REPEAT) and av[1] > 1:
+            yield before, _sample(av[2])
+            for leaf in _walk(av[2]):
+                if leaf[0] in (c.LITERAL, c.NOT_LITERAL, c.ANY, c.IN):
+                    yield before, _sample([leaf])
+        if op in (c.MAX_REPEAT, c.MIN_REPEAT, POSSESSIVE_REPEAT):
+            yield from _repeat_pumps(av[2], before)
+        elif op == c.SUBPATTERN:
+            yield from _repeat_pumps(av[-1], before)
+        elif op == ATOMIC_GROUP:
+            yield from _repeat_pumps(av, before)
+        elif op == c.BRANCH:
+            for alt in av[1]:
+                yield from _repeat_pumps(alt, before)
+        elif op in (c.ASSERT, c.ASSERT_NOT):
+            yield from _repeat_pumps(av[1], before)
+
+
+def _walk(items):
+    for item in items:
+        yield item
+        op, av = item
+        if op in (c.MAX_REPEAT, c.MIN_REPEAT, POSSESSIVE_REPEAT):
+            yield from _walk(av[2])
+        elif op == c.SUBPATTERN:
+            yield from _walk(av[-1])
+        elif op == ATOMIC_GROUP:
+            yield from _walk(av)
+        elif op == c.BRANCH:
+            for alt in av[1]:
+                yield from _walk(alt)
+        elif op in (c.ASSERT, c.ASSERT_NOT):
+            yield from _walk(av[1])
+
+
+def _sample(items):
+    """A short string matched by `items`, ignoring anchors and lookarounds."""
+    ret = ''
+    for op, av in items:
+        if op == c.LITERAL:
+            ret += chr(av)
+        elif op in (c.NOT_LITERAL, c.ANY, c.IN):
+            chars = _chars([(op, av)])
+            ret += min(chars) if chars else ''
+        elif op in (c.MAX_REPEAT, c.MIN_REPEAT, POSSESSIVE_REPEAT):
+            ret += _sample(av[2]) * max(av[0], 1)
+        elif op == c.SUBPATTERN:
+            ret += _sample(av[-1])
+        elif op == ATOMIC_GROUP:
+            ret += _sample(av)
+        elif op == c.BRANCH:
+            ret += _sample(av[1][0])
+    return ret
+
+
+def _show(items):
+    """Approximate source text for parsed items, for messages."""
+    out = ''
+    for op, av in items:
+        if op == c.LITERAL:
+            out += re.escape(chr(av))
+        elif op == c.NOT_LITERAL:
+            out += f'[^{re.escape(chr(av))}]'
+        elif op == c.ANY:
+            out += '.'
+        elif op == c.IN:
+            out += _show_in(av)
+        elif op in (c.MAX_REPEAT, c.MIN_REPEAT, POSSESSIVE_REPEAT):
+            low, high, body = av
+            inner = _show(body)
+            if len(body) > 1 or (body and body[0][0] in (c.BRANCH,)):
+                inner = f'(?:{inner})'
+            if (low, high) == (0, _UNBOUNDED):
+                q = '*'
+            elif (low, high) == (1, _UNBOUNDED):
+                q = '+'
+            elif (low, high) == (0, 1):
+                q = '?'
+            elif high == _UNBOUNDED:
+                q = f'{{{low},}}'
+            else:
+                q = f'{{{low},{high}}}'
+            out += inner + q + ('?' if op == c.MIN_REPEAT else '+' if op == POSSESSIVE_REPEAT else '')
+        elif op == c.SUBPATTERN:
+            out += f'({_show(av[-1])})'
+        elif op == ATOMIC_GROUP:
+            out += f'(?>{_show(av)})'
+        elif op == c.BRANCH:
+            alts = '|'.join(_show(alt) for alt in av[1])
+            out += alts if len(items) == 1 else f'(?:{alts})'
+        elif op == c.AT:
+            out += {c.AT_BEGINNING: '^', c.AT_END: '$', c.AT_BOUNDARY: r'\b'}.get(av, '')
+        elif op in (c.ASSERT, c.ASSERT_NOT):
+            out += f'(?{"=" if op == c.ASSERT else "!"}{_show(av[1])})'
+    return out
+
+
+_CATEGORY_TEXT = {
+    'CATEGORY_DIGIT': r'\d', 'CATEGORY_NOT_DIGIT': r'\D',
+    'CATEGORY_SPACE': r'\s', 'CATEGORY_NOT_SPACE': r'\S',
+    'CATEGORY_WORD': r'\w', 'CATEGORY_NOT_WORD': r'\W',
+}
+
+
+def _show_in(items):
+    if len(items) == 1 and items[0][0] == c.CATEGORY:
+        return _CATEGORY_TEXT.get(str(items[0][1]), '.')
+    out = ''
+    for op, av in items:
+        if op == c.NEGATE:
+            out += '^'
+        elif op == c.LITERAL:
+            out += re.escape(chr(av))
+        elif op == c.RANGE:
+            out += f'{re.escape(chr(av[0]))}-{re.escape(chr(av[1]))}'
+        elif op == c.CATEGORY:
+            out += _CATEGORY_TEXT.get(str(av), '')
+    return f'[{out}]'
@@ -0,0 +1,145 @@
+"""
+Reports on what makes a generated syntax slow or large.
+
+`conflict_report` lists the LL(1) conflicts of a grammar. Where a
+nonterminal's lookahead table maps a terminal to several productions, the
+generated syntax sets a branch point and tries the productions in turn,
+rescanning the input each time one fails. Each conflicting nonterminal is
+reported with the terminals it conflicts on and where it was written, most
+expensive first.
+
+`footprint_report` attributes the contexts of a generated syntax, their
+matches and their size in the dumped file to the `.sbnf` rules they were
+generated for, largest first.
+"""
+from dataclasses import dataclass, field
+import re
+from typing import Optional
+
+from .contexts import Match
+from .types import SourceSpan
+
+
+@dataclass
+class ConflictReport:
+    nonterminal: str
+    rules: list[str]
+    span: Optional[SourceSpan]
+    num_productions: int
+    # (regex, passive, indices of the productions it selects)
+    conflicts: list[tuple[str, bool, tuple[int, ...]]] = field(default_factory=list)
+    # Number of productions tried in vain when every branch but the last
+    # fails, weighted by the length of the productions.
+    cost: float = 0.0
+
+    def __str__(self):
+        where = str(self.span) if self.span is not None else ', '.join(self.rules)
+        lines = [
+            f'{where}: {self.nonterminal} ({self.num_productions} productions, '
+            f'cost {self.cost:g})'
+        ]
+        for regex, passive, indices in self.conflicts:
+            prefix = '~' if passive else ''
+            productions = ', '.join(map(str, indices))
+            lines.append(f'    {prefix}{regex!r} -> productions {productions}')
+        return '\n'.join(lines)
+
+
+def conflict_report(grammar):
+    """Returns a report for each nonterminal of `grammar` that isn't LL(1)."""
+    reports = []
+    for nt, alternation in grammar.rules.items():
+        table, passives_table = grammar.table[nt]
+        conflicts = [
+            (regex, passive, tuple(sorted(indices)))
+            for passive, t in ((False, table), (True, passives_table))
+            for regex, indices in sorted(t.items())
+            if len(indices) > 1
+        ]
+        if not conflicts:
+            continue
+        lengths = [len(p.concats) or 1 for p in alternation.productions]
+        cost = sum(
+            (len(indices) - 1) * sum(lengths[i] for i in indices) / len(indices)
+            for _, _, indices in conflicts
+        )
+        reports.append(ConflictReport(
+            nt.name,
+            sorted(grammar.source_rules([nt])),
+            _span(grammar, nt),
+            len(alternation.productions),
+            conflicts,
+            cost,
+        ))
+    return sorted(reports, key=lambda r: (-r.cost, r.nonterminal))
+
+
+def _span(grammar, nt):
+    """
+    The span of the source of `nt`. Rules that were inlined or that come
+    from rules without a span are located through the rules using them.
+    """
+    seen = set()
+    to_do = [nt]
+    while to_do:
+        nt = to_do.pop()
+        if nt in seen:
+            continue
+        seen.add(nt)
+        alternation = grammar.rules.get(nt)
+        if alternation is not None and alternation.span is not None:
+            return alternation.span
+        to_do.extend(sorted(grammar.referrers.get(nt, ()), key=lambda nt: nt.name))
+    return None
+
+
+@dataclass
+class FootprintReport:
+    rule: Optional[str]
+    # Contexts shared by several rules are split evenly between them, so
+    # these can be fractional.
+    contexts: float = 0.0
+    matches: float = 0.0
+    bytes: float = 0.0
+
+    def __str__(self):
+        rule = self.rule if self.rule is not None else '<fixed contexts>'
+        return (f'{rule}: {self.bytes:.0f} bytes, {_count(self.contexts)} contexts, '
+                f'{_count(self.matches)} matches')
+
+
+def _count(x):
+    return f'{x:.1f}'.removesuffix('.0')
+
+
+# A context's key in the dumped file: indented once, and not a sequence item
+# or the `: value` that follows keys longer than 128 characters (those are
+# written as `? key`).
+_CONTEXT_KEY = re.compile(rb'^  (?! |: |- )', re.MULTILINE)
+
+
+def footprint_report(syntax):
+    """
+    Returns a report for each source rule of `syntax`, a `SublimeSyntax`,
+    with the contexts generated for it, their matches and the bytes they
+    take in the dumped file.
+    """
+    dumped = syntax.dump().encode()
+    body = dumped[dumped.index(b'\ncontexts:\n') + len(b'\ncontexts:\n'):]
+    starts = [m.start() for m in _CONTEXT_KEY.finditer(body)] + [len(body)]
+    if len(starts) != len(syntax.contexts) + 1:
+        raise ValueError('Could not split the dumped syntax into its contexts')
+
+    reports = {}
+    sources = syntax.context_sources()
+    for (name, context), start, end in zip(syntax.contexts.items(), starts, starts[1:]):
+        rules = sources[name] or (None,)
+        matches = sum(isinstance(entry, Match) for entry in context)
+        for rule in rules:
+            if rule not in reports:
+                reports[rule] = FootprintReport(rule)
+            report = reports[rule]
+            report.contexts += 1 / len(rules)
+            report.matches += matches / len(rules)
+            report.bytes += (end - start) / len(rules)
+    return sorted(reports.values(), key=lambda r: (-r.bytes, r.rule or ''))
@@ -0,0 +1,257 @@
+"""
+A long-running compile server. Requests and responses are JSON objects, one
+per line, read from stdin and written to stdout or exchanged over a Unix
+socket. A request looks like
+
+    {"id": 1, "input": "path/to/grammar.sbnf", "output": "out.sublime-syntax",
+     "args": ["global", "args"]}
+
+`input` may be replaced by `text` (the `.sbnf` source) together with `name`
+(the name of the syntax, which otherwise defaults to the basename of
+`input`). Without `output` the generated syntax is returned in the
+response's `syntax` field; with it the file is written if it changed and
+`written` says whether it was. Failed requests get `error` instead.
+Responses carry the request's `id` and may arrive out of order.
+
+Requests are compiled in a number of worker processes. Each keeps a
+bounded LRU cache of an `IncrementalCompiler` for each recently used
+(grammar, global args, name), so that compiling a new version of a grammar
+only redoes the work for the rules that changed. Requests for the same
+grammar, args and name always go to the same worker.
+"""
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+import contextlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import re
+import socketserver
+import stat
+import sys
+import threading
+import zlib
+
+from . import IncrementalCompiler, write_if_changed
+from .types import SublimeSyntaxOptions
+
+
+class _CacheEntry:
+    def __init__(self, global_args, options, jobs, path):
+        self.lock = threading.Lock()
+        self.compiler = IncrementalCompiler(global_args, options, jobs, path)
+        self.text = None
+        self.syntax = None
+
+    def unchanged(self, text):
+        """
+        Whether the last compile was of `text`, with the same content in
+        the modules it imported.
+        """
+        if text != self.text:
+            return False
+        for path, module_text in self.compiler.parser.module_texts.items():
+            try:
+                with open(path) as f:
+                    if f.read() != module_text:
+                        return False
+            except OSError:
+                return False
+        return True
+
+
+class CompileServer:
+    """
+    Compiles requests in this process with `handle`, or hands them out to
+    `workers` processes with `submit_line`. Each worker process keeps
+    `cache_size` compilers.
+    """
+    def __init__(self, cache_size=16, workers=4, jobs=1):
+        self.cache_size = cache_size
+        self.workers = workers
+        self.jobs = jobs
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.pools = None
+        self.pools_lock = threading.Lock()
+
+    def handle(self, request):
+        """Returns the response to a decoded request."""
+        response = {'id': request.get('id')}
+        try:
+            response.update(self._compile(request))
+        except Exception as e:
+            response['error'] = f'{type(e).__name__}: {e}'
+        return response
+
+    def handle_line(self, line):
+        try:
+            request = _decode(line)
+        except ValueError as e:
+            return json.dumps({'id': None, 'error': f'Bad request: {e}'})
+        return json.dumps(self.handle(request))
+
+    def submit_line(self, line):
+        """
+        Hands a request line to a worker process. Returns a future of the
+        response line.
+        """
+        response = Future()
+        try:
+            request = _decode(line)
+        except ValueError as e:
+            response.set_result(json.dumps({'id': None, 'error': f'Bad request: {e}'}))
+            return response
+
+        key = json.dumps([request.get('input'), request.get('args'), request.get('name')])
+        pools = self._pools()
+        compiled = pools[zlib.crc32(key.encode()) % len(pools)].submit(_handle_in_worker, request)
+
+        def done(compiled):
+            try:
+                response.set_result(compiled.result())
+            except Exception as e:
+                # The worker died.
+                response.set_result(json.dumps(
+                    {'id': request.get('id'), 'error': f'{type(e).__name__}: {e}'}))
+        compiled.add_done_callback(done)
+        return response
+
+    def _pools(self):
+        with self.pools_lock:
+            if self.pools is None:
+                # Workers are started fresh rather than forked from this
+                # process, which may be running threads.
+                context = multiprocessing.get_context('spawn')
+                self.pools = [
+                    ProcessPoolExecutor(
+                        max_workers=1, mp_context=context, initializer=_init_worker,
+                        initargs=(self.cache_size, self.jobs))
+                    for _ in range(max(self.workers, 1))
+                ]
+            return self.pools
+
+    def shutdown(self):
+        """Waits for the submitted requests, and stops the workers."""
+        with self.pools_lock:
+            for pool in self.pools or ():
+                pool.shutdown()
+            self.pools = None
+
+    def _compile(self, request):
+        if 'text' in request:
+            text = request['text']
+            if 'name' not in request:
+                raise ValueError('"name" is required with "text"')
+        elif 'input' in request:
+            with open(request['input']) as f:
+                text = f.read()
+        else:
+            raise ValueError('Either "input" or "text" is required')
+        name = request.get('name') \
+            or re.sub(r'\.sbnf$', '', os.path.basename(request['input']))
+        global_args = list(request.get('args', []))
+
+        entry = self._entry(request.get('input'), global_args, name)
+        with entry.lock:
+            if not entry.unchanged(text):
+                # Drop the old text first, so a failed compile isn't
+                # mistaken for a cached result next time.
+                entry.text = None
+                entry.syntax = entry.compiler.compile(text).dump()
+                entry.text = text
+            syntax = entry.syntax
+
+        if 'output' not in request:
+            return {'syntax': syntax}
+        return {'output': request['output'],
+                'written': write_if_changed(request['output'], syntax)}
+
+    def _entry(self, path, global_args, name):
+        key = (path, tuple(global_args), name)
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            entry = self.cache[key] = _CacheEntry(
+                global_args, SublimeSyntaxOptions(name), self.jobs, path)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return entry
+
+    # ---
+
+    def serve_stdio(self):
+        # The parser prints syntax error locations to stdout; keep them out
+        # of the responses.
+        outfile = sys.stdout
+        write_lock = threading.Lock()
+
+        def respond(response):
+            with write_lock:
+                outfile.write(response.result() + '\n')
+                outfile.flush()
+
+        with contextlib.redirect_stdout(sys.stderr):
+            for line in sys.stdin:
+                if line.strip():
+                    self.submit_line(line).add_done_callback(respond)
+            self.shutdown()
+
+    def serve_unix(self, path):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    for line in self.rfile:
+                        if not line.strip():
+                            continue
+                        response = server.submit_line(line).result()
+                        self.wfile.write(response.encode() + b'\n')
+                        self.wfile.flush()
+                except ConnectionError:
+                    # The client went away.
+                    pass
+
+        # A socket left behind by a server that was killed.
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        with contextlib.redirect_stdout(sys.stderr), \
+                socketserver.ThreadingUnixStreamServer(path, Handler) as unix_server:
+            try:
+                unix_server.serve_forever()
+            finally:
+                os.unlink(path)
+                self.shutdown()
+
+
+def _decode(line):
+    request = json.loads(line)
+    if not isinstance(request, dict):
+        raise ValueError('request should be a JSON object')
+    return request
+
+
+# The CompileServer of a worker process.
+_worker = None
+
+
+def _init_worker(cache_size, jobs):
+    global _worker
+    # The parser prints syntax error locations to stdout, which a worker
+    # shares with the server; keep them out of the responses.
+    sys.stdout = sys.stderr
+    _worker = CompileServer(cache_size, jobs=jobs)
+    threading.Thread(target=_exit_with_parent, daemon=True).start()
+
+
+def _exit_with_parent():
+    # A server that is killed can't stop its workers.
+    multiprocessing.connection.wait([multiprocessing.parent_process().sentinel])
+    os._exit(1)
+
+
+def _handle_in_worker(request):
+    return json.dumps(_worker.handle(request))
@@ -1,5 +1,9 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import replace
 from functools import wraps
+import re
+import sys
 from typing import Optional
 
 try:
@@ -7,18 +11,16 @@ try:
 except ImportError:
     from ruamel import yaml
 
-from .bnf import NonLeftRecursiveGrammar
+from .bnf import NonLeftRecursiveGrammar, LazyMapping
+from .char_sets import disjoint, first_chars, parse_regex, run_chars
+from .contexts import (
+    Match, Include, MetaScope, MetaIncludePrototype, factor_variables, lookahead,
+    to_yaml,
+)
+from .corpus import by_frequency, terminal_frequencies
 from .types import Terminal, Nonterminal, Concatenation, SublimeSyntaxOptions
 
 
-def L(l):
-    if len(l) == 1:
-        return l[0]
-    ret = yaml.comments.CommentedSeq(l)
-    ret.fa.set_flow_style()
-    return ret
-
-
 def enqueue_todo(_f_context):
     def decorator(_f_name):
         @wraps(_f_name)
@@ -33,33 +35,40 @@ def enqueue_todo(_f_context):
                     name, compute = name
                 else:
                     compute = True
+            name = sys.intern(name)
 
             if compute:
-                triple = (_f_context, args, proto)
-                if (existing := self.seen_already.get(name, triple)) != triple:
-                    print('repeated name with different context:', name)
-                    print('existing:', existing)
-                    print('new:' , triple)
-                    raise ValueError('already seen')
-                self.seen_already[name] = (_f_context, args, proto)
-                self.to_do.append((name, _f_context, args, proto))
+                self._enqueue(name, _f_context, args, proto)
 
             return name
         return new_f
     return decorator
 
 
+# Backreferences are numbered, so patterns using them can't be combined.
+_BACKREFERENCE = re.compile(r'\\(?:[1-9]|k<)')
+
+# The most terminals fused into one match.
+FUSE_MAX = 3
+
+# The most terminals looked at to pick a production without branching.
+LOOKAHEAD_MAX = 3
+
+
 def np(s):
     return replace(s, passive=False)
 
 
-def _sorted(l, sort_table):
+def _sorted(l, sort_table, frequencies=None):
     def key(kv):
         return (sort_table.get(kv[0], 0), tuple(sorted(kv[1])), kv[0])
-    return sorted(
+    ret = sorted(
         l,
         key=key,
     )
+    if frequencies is not None:
+        ret = by_frequency(ret, frequencies)
+    return ret
 
 
 class SublimeSyntax:
@@ -102,52 +111,189 @@ class SublimeSyntax:
         self,
         grammar: NonLeftRecursiveGrammar,
         options: SublimeSyntaxOptions,
+        previous: Optional['SublimeSyntax'] = None,
+        jobs: int = 1,
     ):
-        self.grammar = grammar
-        self.options = options
-        self.scope_postfix = options.scope_postfix
-
-        self.np_table = {}
-        self.p_table = {}
-        for nt, (np_table, p_table) in grammar.table.items():
-            self.np_table[nt] = _sorted(np_table.items(), grammar.sort_table)
-            self.p_table[nt] = _sorted(p_table.items(), grammar.sort_table)
-
-        self.to_do = []
-        self.seen_already = {}
-
+        """
+        If `previous` was generated from an earlier version of `grammar`,
+        its contexts are reused wherever the rule, FIRST and FOLLOW sets
+        they were generated from are unchanged.
+
+        With `jobs` > 1, the contexts of each nonterminal are generated in
+        a pool of that many worker processes first, and then collected in
+        the same order as they would be generated serially.
+        """
+        self._setup(grammar, options)
+
+        start = self._symbol_name(grammar.start)
         self.contexts = {
-            'pop1!': [{'match': '', 'pop': 1}],
-            'pop2!': [{'match': '', 'pop': 2}],
-            'pop3!': [{'match': '', 'pop': 3}],
-            'pop5!': [{'match': '', 'pop': 5}],
-            'consume!': [{'match': r'\S', 'scope': f'meta.consume{self.scope_postfix}', 'pop': 3}],
-            'fail!': [{'match': r'(?=\S)', 'pop': 1}],
-            'fail1!': [{'match': r'\S', 'scope': f'invalid.illegal{self.scope_postfix}', 'set': 'reset1!'}],
-            'reset1!': [
-                {'match': r'\S', 'scope': f'invalid.illegal{self.scope_postfix}'},
-                {'match': r'\n', 'set': L(['fail1!', 'fail2!', self._symbol_name(grammar.start)])}
-            ],
-            'fail2!': [{'match': r'\S', 'scope': f'invalid.illegal{self.scope_postfix}', 'set': 'reset2!'}],
-            'reset2!': [
-                {'match': r'\S', 'scope': f'invalid.illegal{self.scope_postfix}'},
-                {'match': r'\n', 'set': L(['fail2!', self._symbol_name(grammar.start)])}
-            ],
-            'main': [{'match': '', 'push': L([
-                'fail1!', 'fail2!', self._symbol_name(grammar.start)
-            ])}]
+            'pop1!': (Match('', pop=1),),
+            'pop2!': (Match('', pop=2),),
+            'pop3!': (Match('', pop=3),),
+            'pop5!': (Match('', pop=5),),
+            'consume!': (Match(r'\S', scope=f'meta.consume{self.scope_postfix}', pop=3),),
+            'fail!': (Match(r'(?=\S)', pop=1),),
+            # Filled in by _recovery_contexts once the prototype is known.
+            'fail1!': None,
+            'reset1!': None,
+            'fail2!': None,
+            'reset2!': None,
+            'main': (Match('', push=('fail1!', 'fail2!', start)),),
         }
+        if self.has_prototype and self.all_proto:
+            for name in ('pop1!', 'pop2!', 'pop3!', 'pop5!', 'main'):
+                self.contexts[name] = (MetaIncludePrototype(False),) + self.contexts[name]
 
+        dirty = self._dirty_symbols(previous)
+        generated = {} if jobs <= 1 else _generate_in_parallel(grammar, options, jobs)
         if (proto := Nonterminal('prototype') in grammar.rules):
             _ = self._symbol_name(Nonterminal('prototype'))
         while self.to_do:
             name, _f_context, args, proto = self.to_do.pop(-1)
             if name in self.contexts:
                 continue
-            ctx = _f_context(self, *args)
-            if not proto and 'meta_include_prototype' not in ctx[0]:
-                ctx.insert(0, {'meta_include_prototype': False})
+            triple = (_f_context, args, proto)
+            if name in generated and generated[name][0] == triple:
+                _, ctx, dependencies = generated[name]
+            elif dirty is not None \
+                    and previous.seen_already.get(name) == triple \
+                    and not (isinstance(args[0], Nonterminal)
+                             and (args[0] in dirty or np(args[0]) in dirty)):
+                ctx, dependencies = previous.contexts[name], previous.dependencies[name]
+            else:
+                self._generate_context(name, *triple)
+                continue
             self.contexts[name] = ctx
+            self.dependencies[name] = dependencies
+            for dependency in dependencies:
+                self._enqueue(*dependency)
+
+        self.contexts.update(self._recovery_contexts(start))
+
+    def _setup(self, grammar, options):
+        self.grammar = grammar
+        self.options = options
+        self.scope_postfix = options.scope_postfix
+        self.has_prototype = Nonterminal('prototype') in grammar.rules
+        self.all_proto = all(alternation.proto for alternation in grammar.rules.values())
+
+        self.frequencies = None
+        if options.profile:
+            self.frequencies = terminal_frequencies(
+                (t.regex for t in grammar.terminals), options.profile)
+
+        self.np_table = LazyMapping(
+            grammar.table,
+            lambda nt: _sorted(grammar.table[nt][0].items(), grammar.sort_table, self.frequencies),
+        )
+        self.p_table = LazyMapping(
+            grammar.table,
+            lambda nt: _sorted(grammar.table[nt][1].items(), grammar.sort_table, self.frequencies),
+        )
+
+        self.run_regexes = _run_regexes(grammar) if options.skip_runs else set()
+        self._fusible_cache = {}
+        self._special_regexes = {t.regex for t in grammar.terminals if t.embed or t.include}
+        self.k_lookaheads = LazyMapping(
+            grammar.table,
+            lambda nt: {
+                regex: self._k_lookaheads(nt, regex, sorted(indices))
+                for regex, indices in self.np_table[nt]
+                if len(indices) > 1 and not self.p_table[nt]
+            },
+        )
+
+        self.to_do = []
+        self.seen_already = {}
+        # The contexts enqueued while generating each context, so that it
+        # can be reused by a later version of the syntax.
+        self.dependencies = {}
+        self.contexts = {}
+        self.prototype_stops = self._prototype_stops()
+
+    def _generate_context(self, name, _f_context, args, proto):
+        num_to_do = len(self.to_do)
+        ctx = _merge_lookaheads(_f_context(self, *args))
+        if not isinstance(ctx[0], MetaIncludePrototype) \
+                and (not proto or self._prototype_free(ctx)):
+            ctx.insert(0, MetaIncludePrototype(False))
+        self.contexts[name] = tuple(ctx)
+        self.dependencies[name] = self.to_do[num_to_do:]
+
+    def _prototype_free(self, context):
+        """
+        Whether the prototype can be left out of `context` without changing
+        what is matched. That's the case for contexts that only do
+        bookkeeping: every pattern matches the empty string, so the context
+        acts at once, and there is no meta scope.
+
+        The prototype could then only match in it where a match of its own
+        starts right at the current position. Without the prototype, that
+        match is made by the next context, at the same position and under
+        the same meta scopes, as long as that context includes the
+        prototype (or is itself free of it). Contexts that only pop can
+        expose any context, so they are only free of the prototype when
+        every rule includes it. Bookkeeping contexts don't pop meta scopes
+        other than on the way to a failure, where the prototype was already
+        tried at that position.
+        """
+        if not self.has_prototype:
+            return False
+        for entry in context:
+            if not isinstance(entry, Match) or entry.match != '':
+                return False
+            if entry.fail is not None:
+                continue
+            following = entry.branch or (entry.set or entry.push)[-1:]
+            if not following and not self.all_proto:
+                return False
+            if any(self._excludes_prototype(name) for name in following):
+                return False
+        return True
+
+    def _excludes_prototype(self, name):
+        """Whether the context `name` is generated without the prototype."""
+        if name.startswith('^'):
+            return True
+        triple = self.seen_already.get(name)
+        if triple is None:
+            # The fixed contexts.
+            return False
+        _, args, _ = triple
+        return isinstance(args[0], Nonterminal) and not self.grammar.rules[np(args[0])].proto
+
+    def _recovery_contexts(self, start):
+        """
+        The contexts that mark invalid text after the start symbol fails,
+        until the end of the line (or a sync token, with the SYNC_TOKENS
+        option) where the start symbol is tried again.
+        """
+        invalid = f'invalid.illegal{self.scope_postfix}'
+        run = self._invalid_run()
+        sync = self.options.sync_tokens
+        ret = {}
+        for fail, reset, restart in (
+                ('fail1!', 'reset1!', ('fail1!', 'fail2!', start)),
+                ('fail2!', 'reset2!', ('fail2!', start))):
+            resync = (Match(sync, set=restart),) if sync else ()
+            ret[fail] = resync + (Match(run, scope=invalid, set=(reset,)),)
+            ret[reset] = resync + (Match(run, scope=invalid), Match(r'\n', set=restart))
+        return ret
+
+    def _invalid_run(self):
+        """
+        The regex for a run of invalid text. Characters are consumed one at
+        a time, so that patterns injected by a syntax embedding this one
+        (with `with_prototype`) still match inside invalid text. With the
+        SYNC_TOKENS option, runs of non-space characters are consumed in
+        one match instead, stopping wherever the prototype or a sync token
+        could match. If the prototype's patterns can't be combined into a
+        lookahead, characters are consumed one at a time anyway.
+        """
+        if not self.options.sync_tokens or self.prototype_stops is None:
+            return r'\S'
+        stops = list(self.prototype_stops) + [self.options.sync_tokens]
+        return '(?:(?!' + '|'.join(f'(?:{stop})' for stop in stops) + r')\S)+'
 
     def dump(self):
         out = {
@@ -161,9 +307,100 @@ class SublimeSyntax:
         out['scope'] = self.options.scope
         if self.options.hidden:
             out['hidden'] = True
-        out['contexts'] = self.contexts
+        variables, contexts = factor_variables(self.contexts, self._repeated_regexes())
+        if variables:
+            out['variables'] = variables
+        out['contexts'] = to_yaml(contexts)
         return yaml.round_trip_dump(out, version='1.2')
 
+    def _repeated_regexes(self):
+        """
+        Regexes that may be copied into many match patterns: the terminals,
+        in their contexts and lookaheads, the gap between fused terminals
+        and the run of invalid text.
+        """
+        regexes = {t.regex for t in self.grammar.terminals}
+        regexes.add(self._invalid_run())
+        if self.prototype_stops:
+            regexes.add(_fused_gap(self.prototype_stops))
+        return regexes
+
+    def context_sources(self):
+        """
+        The names of the `.sbnf` rules each context was generated for. A
+        terminal's contexts are shared by every rule using the terminal;
+        the fixed contexts every syntax starts with belong to no rule.
+        """
+        used_in = defaultdict(set)
+        for nt, alternation in self.grammar.rules.items():
+            for production in alternation.productions:
+                for symbol in production.concats:
+                    if isinstance(symbol, Terminal):
+                        used_in[np(symbol)].add(nt)
+        sources = {}
+        ret = {}
+        for name in self.contexts:
+            if name not in self.seen_already:
+                ret[name] = ()
+                continue
+            _, args, _ = self.seen_already[name]
+            subject = np(args[0])
+            if subject not in sources:
+                symbols = used_in[subject] if isinstance(subject, Terminal) else [subject]
+                sources[subject] = tuple(sorted(self.grammar.source_rules(symbols)))
+            ret[name] = sources[subject]
+        return ret
+
+    def _enqueue(self, name, _f_context, args, proto):
+        triple = (_f_context, args, proto)
+        if (existing := self.seen_already.get(name, triple)) != triple:
+            print('repeated name with different context:', name)
+            print('existing:', existing)
+            print('new:' , triple)
+            raise ValueError('already seen')
+        self.seen_already[name] = triple
+        self.to_do.append((name, _f_context, args, proto))
+
+    def _most_frequent_first(self, regexes):
+        """
+        Reorders lookaheads that all take the same action, so any order
+        matches the same way, by their frequency in the profile.
+        """
+        if self.frequencies is None:
+            return regexes
+        return sorted(regexes, key=lambda regex: -self.frequencies.get(regex, 0))
+
+    def _dirty_symbols(self, previous):
+        """
+        The symbols whose contexts can't be reused from `previous`: those
+        whose rule, FIRST or FOLLOW set changed, and those referring to a
+        changed rule (whose context name may have changed). Returns None if
+        nothing can be reused.
+        """
+        if previous is None \
+                or previous.options != self.options \
+                or previous.grammar.start != self.grammar.start \
+                or previous.grammar.sort_table != self.grammar.sort_table \
+                or previous.run_regexes != self.run_regexes \
+                or previous.prototype_stops != self.prototype_stops \
+                or previous.frequencies != self.frequencies \
+                or previous.all_proto != self.all_proto:
+            return None
+        old, new = previous.grammar, self.grammar
+        changed = new.changed_symbols(old)
+        dirty = set(changed)
+        for nt in changed:
+            dirty.update(new.referrers.get(nt, ()))
+        for nt in new.symbols:
+            if old.first.get(nt) != new.first[nt] or old.follow.get(nt) != new.follow[nt]:
+                dirty.add(nt)
+        # Lookaheads over several terminals depend on rules further away.
+        for nt in new.rules:
+            if nt not in dirty and nt in old.rules \
+                    and previous.k_lookaheads[nt] != self.k_lookaheads[nt]:
+                dirty.add(nt)
+        return dirty
+
     # ---
 
     def _production_action(self, np_nt, production, proto):
@@ -171,8 +408,43 @@ class SublimeSyntax:
             return {'pop': 2}
         production_stack = self._production_stack(production, proto=proto)
         if np(production.concats[-1]) == np_nt:
-            return {'push': L(production_stack[1:])}
-        return {'set': L(production_stack)}
+            return {'push': production_stack[1:]}
+        return {'set': production_stack}
+
+    def _production_matches(self, np_nt, production, proto):
+        """
+        LL(1) fast path: if the production starts with a plain terminal, then
+        once the production has been chosen that terminal can't fail. So
+        instead of looking ahead and pushing the terminal's own context (plus
+        the `pop2!` that would catch its failure), match it directly and
+        push only the rest of the production. Terminals fused with it (see
+        `_fused_matches`) are tried first. Returns no matches if the fast
+        path doesn't apply.
+        """
+        if not production.concats:
+            return []
+        first = production.concats[0]
+        if not isinstance(first, Terminal) \
+                or first.passive or first.embed or first.include:
+            return []
+
+        fused = self._fused_run(production.concats, 0)
+        stops = self.prototype_stops if proto else ()
+        matches = [
+            self._rest_action(np_nt, match, production.concats[len(run):], proto)
+            for match, run in self._fused_matches(first, fused, stops)
+        ]
+        return matches + [self._rest_action(
+            np_nt, self._terminal_match(first), production.concats[1:], proto)]
+
+    def _rest_action(self, np_nt, match, rest, proto):
+        """`match`, followed by the rest of a production."""
+        if not rest:
+            return match._replace(pop=2)
+        production_stack = self._production_stack(Concatenation(rest), proto=proto)
+        if np(rest[-1]) == np_nt:
+            return match._replace(push=production_stack[1:])
+        return match._replace(set=production_stack)
 
     def _nonterminal_np_np(self, np_nt, passive_exists):
         np_table = self.np_table[np_nt]
@@ -183,47 +455,129 @@ class SublimeSyntax:
         prods = self.grammar.rules[np_nt].productions
         proto = self.grammar.rules[np_nt].proto
         skip_follow = self._skip_follow(np_nt)
-        context = [] if proto else [{'meta_include_prototype': False}]
+        context = [] if proto else [MetaIncludePrototype(False)]
 
         if len(prods) == 1:
-            match = {'match': ''}
+            if (matches := self._production_matches(np_nt, prods[0], proto)):
+                return context + matches + [Include('fail!')]
             action = self._production_action(np_nt, prods[0], proto)
-            return context + [{**match, **action}]
+            return context + [Match('', **action)]
 
         for regex, indices in np_table:
-            match = {'match': f'(?={regex})'}
+            match = lookahead(regex)
             sorted_indices = sorted(indices)
+            if len(sorted_indices) > 1 and not passive_exists:
+                for i, k_regex in self.k_lookaheads[np_nt][regex]:
+                    # Checked against the follow set like a branch would.
+                    follow = () if skip_follow else (self._follow_name(np_nt), 'pop2!')
+                    production_stack = self._production_stack(prods[i], proto=proto)
+                    context.append(Match(lookahead(k_regex), set=follow + production_stack))
             if len(sorted_indices) == 1:
                 production = prods[sorted_indices[0]]
                 if not passive_exists or (skip_follow and len(production.concats) == 0):
+                    if (fast_matches := self._production_matches(np_nt, production, proto)):
+                        context.extend(fast_matches)
+                        continue
                     action = self._production_action(np_nt, production, proto)
-                    context.append({**match, **action})
+                    context.append(Match(match, **action))
                     continue
 
-            action = {'set': self._np_np_branch_name(np_nt, sorted_indices)}
-            context.append({**match, **action})
+            context.append(Match(match, set=(self._np_np_branch_name(np_nt, sorted_indices),)))
 
         if passive_exists:
-            context.append({'match': r'(?=\S)', 'set': self._nonterminal_np_p_name(np_nt)})
+            context.append(Match(r'(?=\S)', set=(self._nonterminal_np_p_name(np_nt),)))
         else:
-            context.append({'include': 'fail!'})
+            context.append(Include('fail!'))
         return context
 
+    def _k_lookaheads(self, np_nt, regex, indices):
+        """
+        Lookaheads over up to LOOKAHEAD_MAX terminals that pick one of the
+        productions `indices` of `np_nt`, which all can start with `regex`,
+        without branching. Returns (index, regex) pairs.
+
+        A production is picked by the sequences of terminals it can start
+        with, each up to where it differs from those of every other
+        production: at that terminal, the others can only continue with
+        terminals that can't start at the same character, so they would
+        fail there. Terminals are matched as in `_fused_matches`, so the
+        lookahead only applies where they are separated by spaces and tabs
+        (and not the prototype); elsewhere, the productions are still tried
+        in turn. Productions that can start with passive terminals, or end
+        before they differ, can't be told apart this way.
+        """
+        proto = self.grammar.rules[np_nt].proto
+        stops = self.prototype_stops if proto else ()
+        if stops is None or not self._lookahead_terminal(regex, first=True):
+            return []
+        productions = self.grammar.rules[np_nt].productions
+        start = Terminal(regex)
+        sequences = {
+            i: {
+                s for s in self.grammar.first_k(productions[i].concats, LOOKAHEAD_MAX)
+                if s[:1] in ((), (start,))
+            }
+            for i in indices
+        }
+
+        gap = _fused_gap(stops)
+        ret = []
+        for i in indices:
+            tails = set()
+            for s in sequences[i]:
+                ends = [
+                    self._differs_at(s, t)
+                    for j in indices if j != i
+                    for t in sequences[j]
+                ]
+                if None in ends:
+                    break
+                tails.add(gap.join(f'(?>{t.regex})' for t in s[1:max(ends, default=1) + 1]))
+            else:
+                ret.append((i, f'(?>{regex}){gap}(?:{"|".join(sorted(tails))})'))
+        return ret
+
+    def _differs_at(self, s, t):
+        """
+        The first position where the terminal sequence `s` can't start at
+        the same character as `t`, as long as everything up to there is
+        the same, or None.
+        """
+        for m in range(1, min(len(s), len(t))):
+            if not (self._lookahead_terminal(s[m]) and self._lookahead_terminal(t[m])):
+                return None
+            if s[m] == t[m]:
+                continue
+            first_s, first_t = first_chars(s[m].regex), first_chars(t[m].regex)
+            if disjoint(first_s, first_t) and disjoint(first_s, r'\s'):
+                return m
+            return None
+        return None
+
+    def _lookahead_terminal(self, t, first=False):
+        """
+        Whether the terminal `t` (or regex, for the first terminal) can be
+        part of a lookahead over several terminals.
+        """
+        if first:
+            return t not in self._special_regexes and _combinable(t)
+        return not t.passive and t.regex not in self._special_regexes \
+            and self._fusible(t, follower=True)
+
     def _nonterminal_np_p(self, np_nt):
         p_table = self.p_table[np_nt]
         proto = self.grammar.rules[np_nt].proto
-        context = [] if proto else [{'meta_include_prototype': False}]
+        context = [] if proto else [MetaIncludePrototype(False)]
         skip_follow = self._skip_follow(np_nt)
         for regex, indices in p_table:
-            match = {'match': f'(?={regex})'}
+            match = lookahead(regex)
             sorted_indices = sorted(indices)
             if len(sorted_indices) == 1 \
                     and skip_follow \
                     and not self.grammar.rules[np_nt].productions[sorted_indices[0]].concats:
-                action = {'pop': 2}
+                context.append(Match(match, pop=2))
             else:
-                action = {'push': L(['pop2!', self._np_p_branch_name(np_nt, sorted_indices)])}
-            context.append({**match, **action})
+                context.append(Match(match, push=('pop2!', self._np_p_branch_name(np_nt, sorted_indices))))
         return context
 
     @enqueue_todo(_nonterminal_np_p)
@@ -247,13 +601,10 @@ class SublimeSyntax:
             for regex in set(p_table).union(set(np_table))
         }
         proto = self.grammar.rules[np(p_nt)].proto
-        context = [] if proto else [{'meta_include_prototype': False}]
-        for regex, indices in _sorted(combined_table.items(), self.grammar.sort_table):
-            sorted_indices = sorted(indices)
-            context.append({
-                'match': f'(?={regex})',
-                'pop': 2,
-            })
+        context = [] if proto else [MetaIncludePrototype(False)]
+        regexes = [regex for regex, _ in _sorted(combined_table.items(), self.grammar.sort_table)]
+        for regex in self._most_frequent_first(regexes):
+            context.append(Match(lookahead(regex), pop=2))
         return context
 
     @enqueue_todo(_nonterminal_p_preface_context)
@@ -263,7 +614,7 @@ class SublimeSyntax:
     # ---
 
     def _terminal_p_preface_context(self, pt):
-        return [{'match': f'(?={pt.regex})', 'pop': 2}]
+        return [Match(lookahead(pt.regex), pop=2)]
 
     @enqueue_todo(_terminal_p_preface_context)
     def _terminal_p_preface_name(self, pt):
@@ -273,7 +624,7 @@ class SublimeSyntax:
 
     def _np_np_branch_context(self, np_nt, indices):
         proto = self.grammar.rules[np_nt].proto
-        context = [] if proto else [{'meta_include_prototype': False}]
+        context = [] if proto else [MetaIncludePrototype(False)]
         passive_exists = bool(self.p_table[np_nt])
         branch_name = self._np_np_branch_name(np_nt, indices)
         branches = [
@@ -287,11 +638,7 @@ class SublimeSyntax:
         ]
         if passive_exists:
             branches.append(self._np_np_branch_to_p_name(np_nt))
-        return context + [{
-            'match': '',
-            'branch_point': branch_name,
-            'branch': L(branches),
-        }]
+        return context + [Match('', branch_point=branch_name, branch=tuple(branches))]
 
     @enqueue_todo(_np_np_branch_context)
     def _np_np_branch_name(self, np_nt, indices):
@@ -300,7 +647,7 @@ class SublimeSyntax:
     # ---
 
     def _np_np_branch_to_p_context(self, np_nt):
-        return [{'match': '', 'pop': 1, 'set': self._nonterminal_np_p_name(np_nt)}]
+        return [Match('', set=(self._nonterminal_np_p_name(np_nt),), pop=1)]
 
     @enqueue_todo(_np_np_branch_to_p_context)
     def _np_np_branch_to_p_name(self, np_nt):
@@ -310,18 +657,17 @@ class SublimeSyntax:
 
     def _np_p_branch_context(self, np_nt, indices):
         proto = self.grammar.rules[np_nt].proto
-        context = [] if proto else [{'meta_include_prototype': False}]
+        context = [] if proto else [MetaIncludePrototype(False)]
         branch_name = self._np_p_branch_name(np_nt, indices)
         branches = [
             self._np_p_branch_item_name(np_nt, indices, i)
             for i in indices
         ]
-        branches.append('consume!')
-        return context + [{
-            'match': '',
-            'branch_point': branch_name,
-            'branch': L(branches),
-        }]
+        if self._skip_run(np_nt, indices) is not None:
+            branches.append(self._np_p_branch_skip_name(np_nt, indices))
+        else:
+            branches.append('consume!')
+        return context + [Match('', branch_point=branch_name, branch=tuple(branches))]
 
     @enqueue_todo(_np_p_branch_context)
     def _np_p_branch_name(self, np_nt, indices):
@@ -329,17 +675,47 @@ class SublimeSyntax:
 
     # ---
 
+    def _np_p_branch_skip_context(self, np_nt, indices):
+        regex = self._skip_run(np_nt, indices)
+        return [Match(regex, scope=f'meta.consume{self.scope_postfix}', pop=3)]
+
+    @enqueue_todo(_np_p_branch_skip_context)
+    def _np_p_branch_skip_name(self, np_nt, indices):
+        return f'{self._np_p_branch_name(np_nt, indices, compute=False)}@skip!'
+
+    def _skip_run(self, np_nt, indices):
+        """
+        With the SKIP_RUNS option, the regex a failed passive branch can
+        skip a whole match of instead of a single character, or None.
+
+        That's the case when the branch is only entered through one
+        lookahead, for a regex matching a run of characters from a set
+        that no other terminal (and no whitespace) can start with. Then
+        only that regex can match anywhere in the run, where it always
+        matches up to the end of the run; so every position in the run
+        leads to the same attempt that just failed, and branching at each
+        of them would fail too.
+        """
+        if not self.options.skip_runs:
+            return None
+        regexes = [regex for regex, i in self.p_table[np_nt] if sorted(i) == indices]
+        if len(regexes) != 1 or regexes[0] not in self.run_regexes:
+            return None
+        return regexes[0]
+
+    # ---
+
     def _np_np_branch_item_context(self, np_nt, indices, i, last):
         fail_name = 'pop3!' if last else \
             self._np_np_branch_fail_name(np_nt, indices)
         skip_follow = self._skip_follow(np_nt)
         production = self.grammar.rules[np_nt].productions[i]
         proto = self.grammar.rules[np_nt].proto
-        context = [] if proto else [{'meta_include_prototype': False}]
+        context = [] if proto else [MetaIncludePrototype(False)]
         if not skip_follow:
-            follow = [self._follow_name(np_nt), 'pop2!']
+            follow = (self._follow_name(np_nt), 'pop2!')
         else:
-            follow = []
+            follow = ()
         if not production.concats:
             if not follow:
                 raise ValueError(
@@ -347,14 +723,11 @@ class SublimeSyntax:
                     f'empty production. {repr(np_nt)}, {indices}, {i}')
             else:
                 follow = follow[:1]
-                production_stack = []
+                production_stack = ()
         else:
             production_stack = self._production_stack(production, proto=proto)
 
-        return context + [{
-            'match': '',
-            'set': L(['pop3!', fail_name] + follow + production_stack)
-        }]
+        return context + [Match('', set=('pop3!', fail_name) + follow + production_stack)]
 
     @enqueue_todo(_np_np_branch_item_context)
     def _np_np_branch_item_name(self, np_nt, indices, i, last):
@@ -366,7 +739,7 @@ class SublimeSyntax:
     # ---
 
     def _np_np_branch_fail_context(self, np_nt, indices):
-        return [{'match': '', 'fail': self._np_np_branch_name(np_nt, indices)}]
+        return [Match('', fail=self._np_np_branch_name(np_nt, indices))]
 
     @enqueue_todo(_np_np_branch_fail_context)
     def _np_np_branch_fail_name(self, np_nt, indices):
@@ -379,11 +752,11 @@ class SublimeSyntax:
         skip_follow = self._skip_follow(np_nt)
         production = self.grammar.rules[np_nt].productions[i]
         proto = self.grammar.rules[np_nt].proto
-        context = [] if proto else [{'meta_include_prototype': False}]
+        context = [] if proto else [MetaIncludePrototype(False)]
         if not skip_follow:
-            follow = [self._follow_name(np_nt), 'pop2!']
+            follow = (self._follow_name(np_nt), 'pop2!')
         else:
-            follow = []
+            follow = ()
         if not production.concats:
             if not follow:
                 raise ValueError(
@@ -391,21 +764,14 @@ class SublimeSyntax:
                     f'empty production. {repr(np_nt)}, {indices}, {i}')
             else:
                 follow = follow[:1]
-                production_stack = []
+                production_stack = ()
         else:
             production_stack = self._production_stack(production, proto=proto)
 
         if np(production.concats[-1]) == np_nt:
-            return context + [{
-                'match': '',
-                'push': L(production_stack[2:]),
-                'pop': 2
-            }]
+            return context + [Match('', push=production_stack[2:], pop=2)]
 
-        return context + [{
-            'match': '',
-            'set': L(['pop5!', fail_name] + follow + production_stack)
-        }]
+        return context + [Match('', set=('pop5!', fail_name) + follow + production_stack)]
 
     @enqueue_todo(_np_p_branch_item_context)
     def _np_p_branch_item_name(self, np_nt, indices, i):
@@ -418,8 +784,8 @@ class SublimeSyntax:
 
     def _np_p_branch_fail_context(self, np_nt, indices):
         proto = self.grammar.rules[np_nt].proto
-        context = [] if proto else [{'meta_include_prototype': False}]
-        return context + [{'match': '', 'fail': self._np_p_branch_name(np_nt, indices)}]
+        context = [] if proto else [MetaIncludePrototype(False)]
+        return context + [Match('', fail=self._np_p_branch_name(np_nt, indices))]
 
     @enqueue_todo(_np_p_branch_fail_context)
     def _np_p_branch_fail_name(self, np_nt, indices):
@@ -431,10 +797,10 @@ class SublimeSyntax:
         follow = self.grammar.follow[nt]
         sorted_follow = sorted([t.regex for t in follow if t is not None and not t.passive])
         proto = self.grammar.rules[np(nt)].proto
-        context = [] if proto else [{'meta_include_prototype': False}]
-        for regex in sorted_follow:
-            context.append({'match': f'(?={regex})', 'pop': 2})
-        context.append({'include': 'fail!'})
+        context = [] if proto else [MetaIncludePrototype(False)]
+        for regex in self._most_frequent_first(sorted_follow):
+            context.append(Match(lookahead(regex), pop=2))
+        context.append(Include('fail!'))
         return context
 
     @enqueue_todo(_follow_context)
@@ -444,7 +810,7 @@ class SublimeSyntax:
     # ---
 
     def _fail_context(self, nt, indices):
-        return [{'match': '', 'fail': self._nonpassive_branch_name(nt, indices)}]
+        return [Match('', fail=self._nonpassive_branch_name(nt, indices))]
 
     @enqueue_todo(_fail_context)
     def _fail_name(self, nt, indices):
@@ -457,8 +823,14 @@ class SublimeSyntax:
             raise ValueError('This method should not be called on an empty production')
 
         production_stack = []
-        for symbol in production.concats[::-1]:
-            if not symbol.passive:
+        for i in reversed(range(len(production.concats))):
+            symbol = production.concats[i]
+            if not symbol.passive and (fused := self._fused_run(production.concats, i)):
+                stops = self.prototype_stops if proto else ()
+                production_stack.extend([
+                    self._fused_terminal_name(symbol, fused, stops, proto=proto), 'pop2!'
+                ])
+            elif not symbol.passive:
                 production_stack.extend([self._symbol_name(symbol, proto=proto), 'pop2!'])
             elif isinstance(symbol, Nonterminal):
                 production_stack.extend([
@@ -471,19 +843,16 @@ class SublimeSyntax:
                     self._terminal_p_preface_name(symbol, proto=proto), 'pop2!'
                 ])
 
-        return production_stack[:-1]
+        return tuple(production_stack[:-1])
 
     # ---
 
     def _meta_context(self, nt):
         proto = self.grammar.rules[np(nt)].proto
-        context = [] if proto else [{'meta_include_prototype': False}]
+        context = [] if proto else [MetaIncludePrototype(False)]
         meta_scopes = self.grammar.rules[np(nt)].option_list
         meta_scope = ' '.join([f'{s}{self.scope_postfix}' for s in meta_scopes])
-        return context + [
-            {'meta_scope': meta_scope},
-            {'match': '', 'pop': 2},
-        ]
+        return context + [MetaScope(meta_scope), Match('', pop=2)]
 
     @enqueue_todo(_meta_context)
     def _meta_name(self, nt):
@@ -493,16 +862,19 @@ class SublimeSyntax:
 
     def _meta_wrapper_context(self, nt):
         proto = self.grammar.rules[np(nt)].proto
-        context = [] if proto else [{'meta_include_prototype': False}]
+        context = [] if proto else [MetaIncludePrototype(False)]
         if not nt.passive:
             return context + [
-                {'match': r'(?=\S)', 'set': L([self._meta_name(nt), 'pop2!', self._nonterminal_name(nt)])},
+                Match(r'(?=\S)', set=(self._meta_name(nt), 'pop2!', self._nonterminal_name(nt))),
             ]
-        for regex in set.union(set(self.np_table[np_nt]), set(self.p_table[np_nt])):
-            context.append({
-                'match': f'(?={regex})',
-                'set': L([self._meta_name(np_nt), 'pop2!', self._nonterminal_name(nt)]),
-            })
+        np_nt = np(nt)
+        regexes = set(self.np_table[np_nt]) | set(self.p_table[np_nt])
+        regexes = sorted(regexes, key=lambda r: (self.grammar.sort_table.get(r, 0), r))
+        for regex in self._most_frequent_first(regexes):
+            context.append(Match(
+                lookahead(regex),
+                set=(self._meta_name(np_nt), 'pop2!', self._nonterminal_name(nt)),
+            ))
         return context
 
 
@@ -512,23 +884,23 @@ class SublimeSyntax:
 
     # ---
 
-    def _terminal_context(self, t):
-        match = {'match': t.regex}
-        matches = [match]
-
+    def _terminal_match(self, t):
+        scope = None
         if t.option_list:
-            match['scope'] = ' '.join([f'{s}{self.scope_postfix}' for s in t.option_list])
-
-        if t.option_kv:
-            captures = {}
-            for k, v in t.option_kv.items():
-                try:
-                    int_k = int(k)
-                except ValueError:
-                    continue
-                captures[int_k] = ' '.join([f'{s}{self.scope_postfix}' for s in v.split(' ')])
-            if captures:
-                match['captures'] = captures
+            scope = ' '.join([f'{s}{self.scope_postfix}' for s in t.option_list])
+
+        captures = []
+        for k, v in t.option_kv.items():
+            try:
+                int_k = int(k)
+            except ValueError:
+                continue
+            captures.append((int_k, ' '.join([f'{s}{self.scope_postfix}' for s in v.split(' ')])))
+
+        return Match(t.regex, scope=scope, captures=tuple(captures))
+
+    def _terminal_context(self, t):
+        match = self._terminal_match(t)
 
         if t.embed:
             (embed_regex,), embed_options = t.embed
@@ -538,28 +910,25 @@ class SublimeSyntax:
             if embed_options:
                 if ':' not in embed_options[0]:
                     action['embed_scope'] = embed_options.pop(0)
-                action['escape_captures'] = {}
+                escape_captures = []
                 for o in embed_options:
                     try:
                         k, v = o.split(':')
-                        action['escape_captures'][int(k.strip())] = f'{v.strip()}{self.scope_postfix}'
+                        escape_captures.append((int(k.strip()), f'{v.strip()}{self.scope_postfix}'))
                     except Exception:
                         raise ValueError(f'Bad capture group, expected <int>: <scope>. Found: {o}')
-                if not action['escape_captures']:
-                    del action['escape_captures']
+                action['escape_captures'] = tuple(escape_captures)
             action['pop'] = 2
         elif t.include:
             (include_symbol,), include_options = t.include
             action = {
-                'set': L(['pop2!', 'pop1!', include_options]),
-                'with_prototype': [{'include': self._nonterminal_name(include_symbol)}],
+                'set': ('pop2!', 'pop1!', include_options),
+                'with_prototype': (Include(self._nonterminal_name(include_symbol)),),
             }
         else:
             action = {'pop': 2}
 
-        match.update(**action)
-        matches.append({'include': 'fail!'})
-        return matches
+        return [match._replace(**action), Include('fail!')]
 
     @enqueue_todo(_terminal_context)
     def _terminal_name(self, t):
@@ -567,6 +936,108 @@ class SublimeSyntax:
 
     # ---
 
+    def _fused_run(self, concats, i):
+        """
+        The terminals following `concats[i]` that can be fused with it into
+        one match, see `_fused_matches`.
+        """
+        if self.prototype_stops is None or not self._fusible(concats[i]):
+            return ()
+        run = []
+        for symbol in concats[i + 1:i + FUSE_MAX]:
+            if not self._fusible(symbol, follower=True):
+                break
+            run.append(symbol)
+        return tuple(run)
+
+    def _fusible(self, symbol, follower=False):
+        if not isinstance(symbol, Terminal) or symbol.passive or symbol.embed \
+                or symbol.include or any(k.isdigit() for k in symbol.option_kv):
+            return False
+        key = (symbol.regex, follower)
+        if key not in self._fusible_cache:
+            self._fusible_cache[key] = _fusible_regex(symbol.regex, follower)
+        return self._fusible_cache[key]
+
+    def _fused_matches(self, first, fused, stops):
+        """
+        Matches for `first` followed by each prefix of the terminals `fused`,
+        longest first, together with the terminals each one consumes.
+
+        Between two terminals, the engine skips spaces and tabs (anything
+        else would be caught by `fail!`, or is a newline a single match
+        can't cross) unless the prototype matches first. So `a b` can be
+        matched at once by `(?>a)[ \t]*+(?>b)`, as long as `b` can't start
+        with a space or tab, and the prototype can't match anywhere in
+        between (`stops` are its patterns). Atomic groups keep each regex
+        from backtracking into a different match than it would make on
+        its own. Each terminal's scope goes to a capture group.
+        """
+        gap = _fused_gap(stops)
+        gap_groups = 2 * sum(_num_groups(s) for s in stops)
+
+        terminals = (first,) + fused
+        ret = []
+        for n in range(len(terminals), 1, -1):
+            regex = ''
+            captures = []
+            group = 0
+            for i, t in enumerate(terminals[:n]):
+                if i:
+                    regex += gap
+                    group += gap_groups
+                match = self._terminal_match(t)
+                if match.scope is not None:
+                    group += 1
+                    captures.append((group, match.scope))
+                    regex += f'((?>{t.regex}))'
+                else:
+                    regex += f'(?>{t.regex})'
+                group += _num_groups(t.regex)
+            ret.append((Match(sys.intern(regex), captures=tuple(captures)), terminals[:n]))
+        return ret
+
+    def _fused_terminal_context(self, first, fused, stops):
+        matches = [
+            match._replace(pop=2 * len(run))
+            for match, run in self._fused_matches(first, fused, stops)
+        ]
+        return matches + self._terminal_context(first)
+
+    @enqueue_todo(_fused_terminal_context)
+    def _fused_terminal_name(self, first, fused, stops):
+        return '+'.join(t.name for t in (first,) + fused)
+
+    def _prototype_stops(self):
+        """
+        The patterns of the prototype context, which is included in every
+        context that doesn't opt out of it. None if they can't be combined
+        into one regex.
+        """
+        prototype = Nonterminal('prototype')
+        if prototype not in self.grammar.rules:
+            return ()
+        num_to_do = len(self.to_do)
+        context = self._nonterminal_context(prototype)
+        # Only the patterns are wanted; the contexts it refers to are
+        # enqueued again when it is generated.
+        del self.to_do[num_to_do:]
+        stops = []
+        for entry in context:
+            if isinstance(entry, MetaIncludePrototype):
+                continue
+            if entry == Include('fail!'):
+                stops.append(r'(?=\S)')
+            elif not isinstance(entry, Match) or not entry.match \
+                    or _BACKREFERENCE.search(entry.match) \
+                    or _num_groups(entry.match) is None:
+                return None
+            else:
+                stops.append(entry.match)
+        return tuple(stops)
+
+    # ---
+
     # Called only from _production_stack and generating 'main'
     def _symbol_name(self, symbol, proto=True):
         if isinstance(symbol, Nonterminal):
@@ -585,3 +1056,196 @@ class SublimeSyntax:
         )
 
     # ---
+
+
+# ---
+
+def _run_regexes(grammar):
+    """
+    The terminal regexes of `grammar` that match runs of characters from a
+    set that no other terminal regex, nor whitespace, can start a match
+    with. See `SublimeSyntax._skip_run`.
+    """
+    regexes = sorted(set(t.regex for t in grammar.terminals))
+    first = {regex: first_chars(regex) for regex in regexes}
+    if None in first.values():
+        return set()
+    ret = set()
+    for regex in regexes:
+        run = run_chars(regex)
+        if run is None or not disjoint(run, r'\s'):
+            continue
+        if all(disjoint(run, first[other]) for other in regexes if other != regex):
+            ret.add(regex)
+    return ret
+
+
+def _merge_lookaheads(context):
+    """
+    Merges the lookaheads in `context` that lead to the same action into a
+    single pattern, like the lookaheads for every terminal a production can
+    start with, which would otherwise each repeat the production's stack.
+
+    The engine takes the pattern matching first, and of those matching at
+    the same place, the one listed first. `(?=a|b)` matches where the first
+    of `(?=a)` and `(?=b)` does, so moving `(?=b)` up into `(?=a)` changes
+    nothing as long as none of the patterns in between can match where `b`
+    does. That is known when the characters they can start with are
+    disjoint.
+    """
+    ret = []
+    # For each entry of `ret`: its lookahead bodies, or None if it isn't a
+    # lookahead that can be merged.
+    bodies = []
+    # The last lookahead with each action that can still be merged into.
+    groups = {}
+    for entry in context:
+        body = _lookahead_body(entry) if isinstance(entry, Match) else None
+        if not isinstance(entry, Match):
+            # Only patterns are ordered by where they match.
+            groups.clear()
+        elif body is not None and (i := groups.get(entry._replace(match=''))) is not None \
+                and all(
+                    other is not None and all(disjoint(first_chars(body), first_chars(b))
+                                              for b in other)
+                    for other in bodies[i + 1:]):
+            bodies[i].append(body)
+            continue
+        elif body is not None:
+            groups[entry._replace(match='')] = len(ret)
+        elif first_chars(entry.match) is not None:
+            body = entry.match
+        ret.append(entry)
+        bodies.append([body] if body is not None else None)
+
+    return [
+        entry._replace(match=lookahead('|'.join(entry_bodies)))
+        if isinstance(entry, Match) and entry_bodies is not None and len(entry_bodies) > 1
+        else entry
+        for entry, entry_bodies in zip(ret, bodies)
+    ]
+
+
+def _lookahead_body(match):
+    """
+    The regex `r` if `match` is the lookahead `(?=r)`, and `r` can be
+    merged with other lookaheads: it only starts with known characters,
+    and has no global flags or backreferences. Otherwise None.
+    """
+    if not (match.match.startswith('(?=') and match.match.endswith(')')):
+        return None
+    body = match.match[3:-1]
+    if not _combinable(body) or first_chars(body) is None:
+        return None
+    return body
+
+
+def _num_groups(regex):
+    """The number of capture groups in `regex`, or None if it can't be parsed."""
+    try:
+        return parse_regex(regex).state.groups - 1
+    except (re.error, OverflowError, RecursionError):
+        return None
+
+
+def _fused_gap(stops):
+    """
+    The regex for the spaces and tabs between fused terminals, where none
+    of the patterns `stops` match.
+    """
+    if not stops:
+        return '[ \t]*+'
+    stop = '(?!' + '|'.join(f'(?:{s})' for s in stops) + ')'
+    return f'(?:{stop}[ \t])*+{stop}'
+
+
+def _combinable(regex):
+    """
+    Whether `regex` can be combined with other regexes into one pattern: it
+    can be parsed, sets no global flags and has no backreferences.
+    """
+    try:
+        tree = parse_regex(regex)
+    except (re.error, OverflowError, RecursionError):
+        return False
+    return not (tree.state.flags & (re.I | re.M | re.S | re.X) or _BACKREFERENCE.search(regex))
+
+
+def _fusible_regex(regex, follower):
+    """
+    Whether `regex` can be put in a fused match. A regex following another
+    one also must not start with a space or tab.
+    """
+    if not _combinable(regex):
+        return False
+    if follower:
+        first = first_chars(regex)
+        return first is not None and disjoint(first, r'[ \t]')
+    return True
+
+
+def _generate_in_parallel(grammar, options, jobs):
+    """
+    Generates the contexts of every nonterminal of `grammar`, split into
+    partitions across a pool of `jobs` processes. Returns a dict of
+    name -> ((_f_context, args, proto), context, dependencies).
+    """
+    symbols = [nt for nt in grammar.symbols if not nt.passive]
+    num_partitions = min(len(symbols), jobs * 4)
+    partitions = [symbols[i::num_partitions] for i in range(num_partitions)]
+    generated = {}
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(grammar, options)) as executor:
+        for partition in executor.map(_generate_partition, partitions):
+            for name, item in partition.items():
+                generated.setdefault(name, item)
+    return generated
+
+
+_worker_state = None
+
+
+def _init_worker(grammar, options):
+    global _worker_state
+    _worker_state = (grammar, options)
+
+
+def _generate_partition(partition):
+    """
+    Generates the contexts for the nonterminals in `partition` (including
+    their passive and no-prototype variants, as far as they are used).
+    Contexts of other nonterminals are left to the worker that owns them.
+    """
+    grammar, options = _worker_state
+    ss = SublimeSyntax.__new__(SublimeSyntax)
+    ss._setup(grammar, options)
+    owned = set(partition)
+
+    for symbol in grammar.symbols:
+        if np(symbol) not in owned:
+            continue
+        protos = {True} | set(
+            grammar.rules[referrer].proto
+            for referrer in grammar.referrers.get(symbol, ())
+            if referrer in grammar.rules
+        )
+        for proto in protos:
+            if symbol.passive:
+                ss._nonterminal_p_preface_name(symbol, proto=proto)
+            else:
+                ss._symbol_name(symbol, proto=proto)
+
+    while ss.to_do:
+        name, _f_context, args, proto = ss.to_do.pop(-1)
+        if name in ss.contexts:
+            continue
+        if isinstance(args[0], Nonterminal) and np(args[0]) not in owned:
+            continue
+        ss._generate_context(name, _f_context, args, proto)
+
+    return {
+        name: (ss.seen_already[name], ctx, ss.dependencies[name])
+        for name, ctx in ss.contexts.items()
+    }
@@ -1,5 +1,5 @@
+from collections import defaultdict, deque
 from dataclasses import replace
-from typing import Callable
 
 from .types import (
     Nonterminal, Alternation, Concatenation, Skip,
@@ -7,28 +7,30 @@ from .types import (
 )
 
 NO_PROTO = 'include-prototype: false'
+ROOTS = (Nonterminal('main'), Nonterminal('prototype'))
+
+# Single-production rules whose (inlined) production has at most this many
+# symbols are inlined everywhere; larger ones only when referenced once.
+INLINE_MAX_SIZE = 4
 
 
 def transform_grammar(
     grammar: dict[Nonterminal, Alternation],
 ) -> dict[Nonterminal, Alternation]:
     """
-    Applies a number of "compiler passes" to the input grammar
+    Applies a number of "compiler passes" to the input grammar. The passes
+    (expanding passives, rewriting `?`, `*` and `( ... )`, and collapsing
+    passives) are fused into a single traversal of each production.
     """
     generated_rules = {}
-    to_do = list(grammar.items())
+    # Every position at which a nonterminal is referenced, so that renaming
+    # doesn't have to scan the whole grammar.
+    occurrences = defaultdict(list)
+    to_do = deque(grammar.items())
 
     while to_do:
-        nt, alternation = to_do.pop(0)
-        for transform in (
-            expand_passives,
-            rewrite_optional,
-            rewrite_repetition,
-            rewrite_alternation,
-            collapse_passives,
-        ):
-            alternation = transform(nt, alternation, to_do)
-        generated_rules[nt] = alternation
+        nt, alternation = to_do.popleft()
+        generated_rules[nt] = transform_rule(nt, alternation, to_do, occurrences)
 
     # Rewrite names:
     # rewrite x : y
@@ -51,97 +53,168 @@ def transform_grammar(
     for y, x in to_change.items():
         generated_rules[x] = generated_rules[y]
         del generated_rules[y]
-        for alternation in generated_rules.values():
-            for production in alternation.productions:
-                for i in range(len(production.concats)):
-                    if isinstance(production.concats[i], Nonterminal) \
-                            and production.concats[i] == y:
-                        production.concats[i] = x
-
-    return generated_rules
-
+        y_occurrences = occurrences.pop(y, [])
+        for concats, i in y_occurrences:
+            concats[i] = x
+        occurrences[x].extend(y_occurrences)
 
-def expand_passives(nt, alt, to_do):
-    def expand(expr):
-        if not isinstance(expr, Passive):
-            return [expr]
-        return [Skip(), expr.sub]
+    return inline_rules(generated_rules)
 
-    return replace(alt, productions=[
-        Concatenation([item for old_item in production.concats for item in expand(old_item)])
-        for production in alt.productions
-    ])
 
+def inline_rules(rules, max_size=INLINE_MAX_SIZE):
+    """
+    Splices the production of each trivial rule into the productions that
+    refer to it, so that the generated syntax doesn't need a context (and a
+    `set` to the production's stack) to reach it. A rule is trivial if it
+    has a single production, no meta scope, the same prototype setting as
+    the referring rule, and can only be entered on a non-passive lookahead
+    (otherwise its context skips input, which an inlined production would
+    not do). Passive references are left alone. Rules that become
+    unreferenced are left in place; they are pruned by the grammar.
+    """
+    references = defaultdict(int)
+    for alternation in rules.values():
+        for production in alternation.productions:
+            for symbol in production.concats:
+                if isinstance(symbol, Nonterminal):
+                    references[replace(symbol, passive=False) if symbol.passive else symbol] += 1
+                elif symbol.include is not None:
+                    for include_symbol in symbol.include[0]:
+                        references[include_symbol] += 1
+
+    expansions = {}
+
+    def expansion(nt):
+        if nt not in expansions:
+            expansions[nt] = None  # Guards against recursive rules
+            alternation = rules[nt]
+            expansions[nt] = splice(alternation.productions[0].concats, alternation.proto)
+        return expansions[nt]
+
+    def splice(concats, proto):
+        new_concats = []
+        for symbol in concats:
+            if (is_trivial(symbol, proto)
+                    and (sub := expansion(symbol)) is not None
+                    and (len(sub) <= max_size or references[symbol] == 1)):
+                new_concats.extend(sub)
+            else:
+                new_concats.append(symbol)
+        return new_concats
+
+    def is_trivial(symbol, proto):
+        return (isinstance(symbol, Nonterminal)
+                and not symbol.passive
+                and symbol not in ROOTS
+                and (alternation := rules.get(symbol)) is not None
+                and len(alternation.productions) == 1
+                and not alternation.option_list
+                and alternation.proto == proto
+                and _starts_actively(alternation.productions[0].concats, rules, set()))
+
+    for nt, alternation in rules.items():
+        productions = [
+            Concatenation(splice(production.concats, alternation.proto))
+            for production in alternation.productions
+        ]
+        if productions != alternation.productions:
+            rules[nt] = replace(alternation, productions=productions)
+
+    return rules
+
+
+def _starts_actively(concats, rules, seen):
+    """
+    Conservatively, whether the first set of `concats` contains a
+    non-passive terminal.
+    """
+    if not concats or concats[0].passive:
+        return False
+    first = concats[0]
+    if not isinstance(first, Nonterminal):
+        return True
+    if first in seen or first not in rules:
+        return False
+    seen.add(first)
+    return any(
+        _starts_actively(production.concats, rules, seen)
+        for production in rules[first].productions
+    )
+
+
+def transform_rule(nt, alt, to_do, occurrences):
+    """
+    Rewrites `x?`, `x* ...` and `( ... )` as new nonterminals, and `~x` as a
+    passive `x`, in a single pass over each production. New rules are queued
+    optionals first, then repetitions, then alternations.
+    """
+    options = None if alt.proto else NO_PROTO
+    new_optionals = []
+    new_repetitions = []
+    new_alternations = []
+    num_repetitions = 0
+    num_alternations = 0
 
-def rewrite_optional(nt, alt, to_do):
     def expand(expr):
         if not isinstance(expr, OptionalExpr):
             return expr
         opt_nt = Nonterminal(f'/opt/{expr.name}')
-        to_do.append((opt_nt, Alternation([
-            Concatenation([]), Concatenation([expr.sub])],
-            None if alt.proto else NO_PROTO)))
+        new_optionals.append((opt_nt, Alternation([
+            Concatenation([]), Concatenation([expr.sub])], options, expr.span)))
         return opt_nt
 
-    return replace(alt, productions=[
-        Concatenation([expand(item) for item in production.concats])
-        for production in alt.productions
-    ])
-
-
-def rewrite_repetition(nt, alt, to_do):
-    num = 0
     productions = []
     for prod in alt.productions:
         new_prod = []
-        for i, concat in enumerate(prod.concats):
-            if not isinstance(concat, Repetition):
-                new_prod.append(concat)
-            else:
-                sub = concat.sub
+        skip = False
+        for i, item in enumerate(prod.concats):
+            if isinstance(item, Skip):
+                skip = True
+                continue
+            if isinstance(item, Passive):
+                skip = True
+                item = item.sub
+            item = expand(item)
+
+            repetition = isinstance(item, Repetition)
+            if repetition:
+                span = item.span
+                sub = item.sub
                 while isinstance(sub, Repetition):
                     sub = sub.sub
-                new_nt = Nonterminal(f'/*-{num}/{nt.name}')
-                num += 1
-                new_prod.append(new_nt)
-                to_do.append((new_nt, Alternation(
+                item = Nonterminal(f'/*-{num_repetitions}/{nt.name}')
+                num_repetitions += 1
+                remainder = []
+                for rest in prod.concats[i+1:]:
+                    if isinstance(rest, Passive):
+                        remainder.append(Skip())
+                        rest = rest.sub
+                    remainder.append(expand(rest))
+                new_repetitions.append((item, Alternation(
                     [
-                        Concatenation(prod.concats[i+1:]),
-                        Concatenation([sub, new_nt])
+                        Concatenation(remainder),
+                        Concatenation([sub, item])
                     ],
-                    None if alt.proto else NO_PROTO
+                    options,
+                    span,
                 )))
+            elif isinstance(item, Alternation):
+                new_nt = Nonterminal(f'/alt-{num_alternations}/{nt.name}')
+                num_alternations += 1
+                new_alternations.append((new_nt, Alternation(item.productions, options, item.span)))
+                item = new_nt
+
+            if skip:
+                item = replace(item, passive=True)
+                skip = False
+            if isinstance(item, Nonterminal):
+                occurrences[item].append((new_prod, len(new_prod)))
+            new_prod.append(item)
+            if repetition:
                 break
         productions.append(Concatenation(new_prod))
-    return replace(alt, productions=productions)
-
-
-def rewrite_alternation(nt, alt, to_do):
-    def replace_alt(expr):
-        nonlocal num
-        if not isinstance(expr, Alternation):
-            return expr
-        new_nt = Nonterminal(f'/alt-{num}/{nt.name}')
-        to_do.append((new_nt, replace(
-            expr, options=None if alt.proto else NO_PROTO)))
-        num += 1
-        return new_nt
-
-    num = 0
-    return replace(alt, productions=[
-        Concatenation([replace_alt(c) for c in production.concats])
-        for production in alt.productions
-    ])
 
-
-def collapse_passives(nt, alt, to_do):
-    productions = []
-    for prod in alt.productions:
-        new_prod = []
-        for concat in prod.concats[::-1]:
-            if isinstance(concat, Skip):
-                new_prod[0] = replace(new_prod[0], passive=True)
-            else:
-                new_prod.insert(0, concat)
-        productions.append(Concatenation(new_prod))
-    return replace(alt, productions=productions)
+    to_do.extend(new_optionals)
+    to_do.extend(new_repetitions)
+    to_do.extend(new_alternations)
+    return Alternation(productions, alt.options, alt.span)
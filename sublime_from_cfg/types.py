@@ -1,8 +1,51 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from hashlib import sha256
+import shlex
 from typing import Optional, Union
 
 
+class SourcePosition:
+    """
+    Where a declaration starts in its source file. The spans of everything
+    in the declaration are relative to it, so when an edit above moves the
+    declaration only this needs updating.
+    """
+    def __init__(self, path, lineno):
+        self.path = path
+        self.lineno = lineno
+
+
+@dataclass(frozen=True)
+class SourceSpan:
+    position: SourcePosition
+    start: int
+    end: int
+
+    @property
+    def path(self):
+        return self.position.path
+
+    @property
+    def first_line(self):
+        return self.position.lineno + self.start
+
+    @property
+    def last_line(self):
+        return self.position.lineno + self.end
+
+    def __str__(self):
+        lines = str(self.first_line)
+        if self.last_line != self.first_line:
+            lines += f'-{self.last_line}'
+        return f'{self.path or "<input>"}:{lines}'
+
+
+# The source span of an expression, if it was parsed from a file. It isn't
+# part of the expression's identity.
+def _span_field():
+    return field(default=None, compare=False, repr=False)
+
+
 class Expression:
     @property
     def name(self):
@@ -93,6 +136,7 @@ EMPTY = Concatenation([])
 class Alternation(Expression, OptionsHaver):
     productions: list[Concatenation]
     options: Optional[str] = None
+    span: Optional[SourceSpan] = _span_field()
 
     @property
     def _name(self):
@@ -106,6 +150,7 @@ class Alternation(Expression, OptionsHaver):
 @dataclass(frozen=True)
 class Repetition(Expression):
     sub: Expression
+    span: Optional[SourceSpan] = _span_field()
 
     @property
     def _name(self):
@@ -115,6 +160,7 @@ class Repetition(Expression):
 @dataclass(frozen=True)
 class OptionalExpr(Expression):
     sub: Expression
+    span: Optional[SourceSpan] = _span_field()
 
     @property
     def _name(self):
@@ -138,6 +184,9 @@ class SublimeSyntaxOptions:
     SCOPE: Optional[str] = None
     SCOPE_POSTFIX: Optional[str] = None
     HIDDEN: Optional[str] = None
+    SKIP_RUNS: Optional[str] = None
+    SYNC_TOKENS: Optional[str] = None
+    PROFILE: Optional[str] = None
 
     @property
     def name(self):
@@ -166,3 +215,15 @@ class SublimeSyntaxOptions:
     @property
     def hidden(self):
         return self.HIDDEN == 'true'
+
+    @property
+    def skip_runs(self):
+        return self.SKIP_RUNS == 'true'
+
+    @property
+    def sync_tokens(self):
+        return self.SYNC_TOKENS or None
+
+    @property
+    def profile(self):
+        return self.PROFILE and shlex.split(self.PROFILE)
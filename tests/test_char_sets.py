@@ -0,0 +1,43 @@
+"""
+Tests of the analysis of the characters terminal regexes can start with.
+Regexes that Python's `re` reads differently from Oniguruma must be
+unknown, so that the generator doesn't rely on them.
+"""
+import pytest
+
+from sublime_from_cfg.char_sets import disjoint, first_chars, run_chars
+
+
+@pytest.mark.parametrize('regex', [
+    # Nested sets and set operations, which `re` only warns about.
+    '[^a[b]]',
+    '[a[bc]]x',
+    '[a-z&&[^aeiou]]',
+    '[a-z--[aeiou]]',
+    # `\Z` also matches before a final newline in Oniguruma; `re` has no `\z`.
+    'a|\\Z',
+    '\\Z',
+    '\\z',
+    # Flags Oniguruma doesn't have.
+    '(?a)\\w',
+    '(?a:\\w)x',
+    # Escapes `re` doesn't know.
+    '\\h+',
+    '\\p{Alpha}',
+])
+def test_unknown(regex):
+    assert first_chars(regex) is None
+    assert run_chars(regex) is None
+
+
+@pytest.mark.parametrize('regex', ['[^a[b]]+', '[a-z&&[^aeiou]]+', '(?a)\\w+'])
+def test_unknown_runs(regex):
+    assert run_chars(regex) is None
+
+
+def test_known():
+    assert disjoint(first_chars('[[:alpha:]]\\w*'), first_chars('\\d+|-'))
+    assert not disjoint(first_chars('(?i)a'), first_chars('A'))
+    assert disjoint(first_chars('$'), first_chars('a'))
+    assert not disjoint(first_chars('$'), '\\n')
+    assert run_chars('[a-z]+') is not None
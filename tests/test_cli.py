@@ -0,0 +1,76 @@
+"""
+Tests of `sublime-from-cfg` options that only the command line sets.
+"""
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MAIN = [sys.executable, '-c', 'from sublime_from_cfg.cli import main; main()']
+
+# Without a profile, words are tried first.
+GRAMMAR = """\
+PROFILE = '{profile}'
+
+main : ('[a-z]+'{{word}} | '\\d+'{{number}})* ;
+"""
+
+NUMBERS = '1 2 3 4 5 6 x\n'
+WORDS = 'a b c d e f 1\n'
+
+
+def _run(args, cwd):
+    env = dict(os.environ, PYTHONPATH=ROOT, SUBLIME_FROM_CFG_CACHE_DIR='')
+    return subprocess.run(MAIN + args, cwd=cwd, env=env, capture_output=True, text=True)
+
+
+def _write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def _tried_first(path):
+    with open(path) as f:
+        text = f.read()
+    return 'number' if text.index('scope: number') < text.index('scope: word') else 'word'
+
+
+def test_profile_is_relative_to_the_grammar(tmp_path):
+    _write(tmp_path / 'grammar' / 'samples' / 'a.txt', NUMBERS)
+    _write(tmp_path / 'cwd' / 'samples' / 'a.txt', WORDS)
+    grammar = tmp_path / 'grammar' / 'grammar.sbnf'
+    _write(grammar, GRAMMAR.format(profile='samples/*.txt'))
+
+    result = _run([str(grammar)], cwd=tmp_path / 'cwd')
+    assert result.returncode == 0, result.stderr
+    assert _tried_first(tmp_path / 'grammar' / 'grammar.sublime-syntax') == 'number'
+
+
+def test_command_line_profile_wins(tmp_path):
+    _write(tmp_path / 'my numbers' / 'a.txt', NUMBERS)
+    _write(tmp_path / 'words' / 'a.txt', WORDS)
+    _write(tmp_path / 'grammar.sbnf', GRAMMAR.format(profile='words/*.txt'))
+    output = tmp_path / 'grammar.sublime-syntax'
+
+    result = _run(['grammar.sbnf'], cwd=tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert _tried_first(output) == 'word'
+
+    result = _run(['grammar.sbnf', '--profile', 'my numbers/*.txt'], cwd=tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert _tried_first(output) == 'number'
+
+
+def test_missing_profile(tmp_path):
+    _write(tmp_path / 'samples' / 'a.txt', NUMBERS)
+    _write(tmp_path / 'grammar.sbnf', GRAMMAR.format(profile='missing/*.txt'))
+
+    result = _run(['grammar.sbnf'], cwd=tmp_path)
+    assert 'No files match the profile pattern' in result.stderr
+    assert 'missing/*.txt' in result.stderr
+
+    result = _run(['grammar.sbnf', '--profile', 'samples/*.txt'], cwd=tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert _tried_first(tmp_path / 'grammar.sublime-syntax') == 'number'
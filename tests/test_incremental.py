@@ -0,0 +1,62 @@
+"""
+Checks that `IncrementalCompiler` compiles each version of a grammar the
+same way as compiling it from scratch.
+"""
+import os
+
+import pytest
+
+from sublime_from_cfg import IncrementalCompiler, sublime_from_cfg
+from sublime_from_cfg.types import SublimeSyntaxOptions
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATH = os.path.join(ROOT, 'sbnf', 'sbnf.sbnf')
+
+# Each edit is a list of (old, new) replacements. The edits are applied one
+# after another.
+EDITS = [
+    # A scope.
+    [("`=`{keyword.operator.assignment}", "`=`{keyword.operator.assignment.variable}")],
+    # A production added to a rule used in many places.
+    [("parameter : literal | regex | IDENTIFIER{variable.parameter} ;",
+      "parameter : literal | regex | IDENTIFIER{variable.parameter} | '\\d+'{constant.numeric} ;")],
+    # A rule removed, with its uses.
+    [("literal options? embed-include?", "literal options?"),
+     ("regex options? embed-include?", "regex options?"),
+     ("embed-include\n: '%'\n  'embed|include'{keyword}\n  parameters\n  options\n;\n", "")],
+    # A variable.
+    [("EXTENSIONS = 'sbnf'", "EXTENSIONS = 'sbnf sbnf-modified'")],
+    # The prototype.
+    [("prototype : ( ~comment )* ;", "prototype : ( ~comment | ~'\\\\\\n' )* ;")],
+]
+
+
+@pytest.fixture(autouse=True)
+def no_disk_cache(monkeypatch):
+    monkeypatch.setenv('SUBLIME_FROM_CFG_CACHE_DIR', '')
+
+
+def _versions():
+    with open(PATH) as f:
+        text = f.read()
+    yield text
+    original = text
+    for edit in EDITS:
+        for old, new in edit:
+            assert old in text, old
+            text = text.replace(old, new)
+        yield text
+    # Back to where it started.
+    yield original
+
+
+def test_incremental_compiles_match_fresh_ones():
+    options = SublimeSyntaxOptions('sbnf')
+    compiler = IncrementalCompiler([], options, path=PATH)
+    previous = None
+    for text in _versions():
+        output = compiler.compile(text).dump()
+        assert output == sublime_from_cfg(text, [], options, path=PATH).dump()
+        assert output != previous
+        previous = output
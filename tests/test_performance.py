@@ -0,0 +1,153 @@
+"""
+Regression budgets for compiling the bundled grammars.
+
+Each grammar in `tests/*/` and `sbnf/` is compiled and measured: the
+number of contexts, matches, distinct match regexes and branch points and
+the bytes of the output, as well as the compile time (the best of a few
+runs) and the peak memory allocated by Python while compiling. The
+measurements are compared against `performance_baseline.json`.
+
+The output is deterministic, so a test fails when one of its metrics
+grows past the baseline by more than its tolerance. Time and memory depend
+on the machine and the Python version, so they are only reported: a
+`PerformanceWarning` is shown when they grow past their (loose) tolerance.
+Getting smaller never fails. To record a new baseline after an intended
+change, run
+
+    UPDATE_PERFORMANCE_BASELINE=1 python -m pytest tests/test_performance.py
+"""
+import glob
+import json
+import os
+import re
+import time
+import tracemalloc
+import warnings
+
+import pytest
+
+from sublime_from_cfg import sublime_from_cfg
+from sublime_from_cfg.contexts import Match
+from sublime_from_cfg.types import SublimeSyntaxOptions
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, 'tests', 'performance_baseline.json')
+
+GRAMMARS = sorted(
+    os.path.relpath(path, ROOT)
+    for pattern in ('tests/*/*.sbnf', 'sbnf/*.sbnf')
+    for path in glob.glob(os.path.join(ROOT, pattern))
+)
+
+TIMING_RUNS = 3
+
+# metric: (factor, slack). A measurement may be up to
+# baseline * factor + slack.
+BUDGETS = {
+    'contexts': (1.05, 2),
+    'matches': (1.05, 4),
+    'regexes': (1.05, 2),
+    'branch_points': (1.05, 1),
+    'output_bytes': (1.05, 256),
+}
+
+# Like BUDGETS, but only reported.
+REPORTED = {
+    'seconds': (1.75, 0.05),
+    'peak_bytes': (1.25, 256 * 1024),
+}
+
+UPDATE = bool(os.environ.get('UPDATE_PERFORMANCE_BASELINE'))
+
+
+class PerformanceWarning(UserWarning):
+    pass
+
+
+def _compile(path):
+    with open(os.path.join(ROOT, path)) as f:
+        text = f.read()
+    name = re.sub(r'\.sbnf$', '', os.path.basename(path))
+    syntax = sublime_from_cfg(
+        text, [], SublimeSyntaxOptions(name), path=os.path.join(ROOT, path))
+    return syntax, syntax.dump()
+
+
+def measure(path):
+    seconds = []
+    for _ in range(TIMING_RUNS):
+        start = time.perf_counter()
+        syntax, output = _compile(path)
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        _compile(path)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    matches = [
+        entry
+        for context in syntax.contexts.values()
+        for entry in context
+        if isinstance(entry, Match)
+    ]
+    return {
+        'contexts': len(syntax.contexts),
+        'matches': len(matches),
+        'regexes': len({match.match for match in matches}),
+        'branch_points': sum(1 for match in matches if match.branch_point is not None),
+        'output_bytes': len(output.encode()),
+        'seconds': round(min(seconds), 4),
+        'peak_bytes': peak_bytes,
+    }
+
+
+def _load_baseline():
+    try:
+        with open(BASELINE_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@pytest.fixture(scope='module')
+def baseline():
+    baseline = _load_baseline()
+    yield baseline
+    if UPDATE:
+        with open(BASELINE_PATH, 'w') as f:
+            kept = {path: baseline[path] for path in GRAMMARS if path in baseline}
+            json.dump(kept, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+@pytest.fixture(autouse=True)
+def no_disk_cache(monkeypatch):
+    # Parsed imports cached by earlier runs would make compiles look faster.
+    monkeypatch.setenv('SUBLIME_FROM_CFG_CACHE_DIR', '')
+
+
+def _over(measured, expected, tolerances):
+    for metric, (factor, slack) in tolerances.items():
+        limit = expected[metric] * factor + slack
+        if measured[metric] > limit:
+            yield f'{metric}: {measured[metric]} > {limit:g} (baseline {expected[metric]})'
+
+
+@pytest.mark.parametrize('path', GRAMMARS)
+def test_performance(path, baseline):
+    measured = measure(path)
+    if UPDATE:
+        baseline[path] = measured
+        return
+    if path not in baseline:
+        pytest.fail(
+            f'{path} has no baseline; run with UPDATE_PERFORMANCE_BASELINE=1')
+
+    for report in _over(measured, baseline[path], REPORTED):
+        warnings.warn(f'{path}: {report}', PerformanceWarning)
+    regressions = list(_over(measured, baseline[path], BUDGETS))
+    assert not regressions, f'{path}: ' + '; '.join(regressions)
@@ -0,0 +1,125 @@
+"""
+End-to-end tests of the compile server's request/response protocol, run
+against `sublime-from-cfg --serve` in a separate process.
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from sublime_from_cfg import sublime_from_cfg
+from sublime_from_cfg.types import SublimeSyntaxOptions
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVE = [
+    sys.executable, '-c', 'from sublime_from_cfg.cli import main; main()',
+    '--serve', '--workers', '2',
+]
+
+TIMEOUT = 120
+
+
+@pytest.fixture
+def server(tmp_path):
+    env = dict(os.environ, SUBLIME_FROM_CFG_CACHE_DIR='')
+    process = subprocess.Popen(
+        SERVE, cwd=ROOT, env=env, text=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    yield process
+    try:
+        process.communicate(timeout=TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+
+
+def _request(server, request):
+    server.stdin.write((request if isinstance(request, str) else json.dumps(request)) + '\n')
+    server.stdin.flush()
+    return json.loads(server.stdout.readline())
+
+
+def _compile(path):
+    with open(os.path.join(ROOT, path)) as f:
+        text = f.read()
+    name = os.path.basename(path)[:-len('.sbnf')]
+    return sublime_from_cfg(text, [], SublimeSyntaxOptions(name), path=path).dump()
+
+
+def test_compiles_requests(server, tmp_path):
+    requests = [
+        {'id': 1, 'text': 'main : `a`{a} ;', 'name': 'text'},
+        {'id': 2, 'input': 'tests/sort/sort.sbnf'},
+        {'id': 3, 'input': 'tests/params/params.sbnf', 'args': ['foo'],
+         'output': str(tmp_path / 'params.sublime-syntax')},
+    ]
+    out, _ = server.communicate(
+        ''.join(json.dumps(request) + '\n' for request in requests), timeout=TIMEOUT)
+    # Responses may arrive in any order.
+    responses = {response['id']: response for response in map(json.loads, out.splitlines())}
+
+    assert responses.keys() == {1, 2, 3}
+    assert 'a.text' in responses[1]['syntax']
+    assert responses[2]['syntax'] == _compile('tests/sort/sort.sbnf')
+    assert responses[3]['written'] is True
+    with open(tmp_path / 'params.sublime-syntax') as f:
+        assert 'name: params' in f.read()
+
+
+def test_reports_errors(server):
+    assert _request(server, '[1, 2')['error'].startswith('Bad request')
+    assert _request(server, '[1, 2]') == {
+        'id': None, 'error': 'Bad request: request should be a JSON object'}
+    assert 'required' in _request(server, {'id': 1})['error']
+    assert 'required' in _request(server, {'id': 2, 'text': 'main : `a` ;'})['error']
+    # Syntax errors are printed by the parser; that mustn't end up among
+    # the responses.
+    response = _request(server, {'id': 3, 'text': 'main : `a`', 'name': 'broken'})
+    assert response['id'] == 3 and 'error' in response
+    response = _request(server, {'id': 4, 'text': 'main : `a` ;', 'name': 'fixed'})
+    assert response['id'] == 4 and 'syntax' in response
+
+
+def test_reuses_output_until_something_changes(server, tmp_path):
+    (tmp_path / 'main.sbnf').write_text('%import `lib.sbnf`\nmain : word ;\n')
+    (tmp_path / 'lib.sbnf').write_text('word : `a`{a} ;\n')
+    output = str(tmp_path / 'main.sublime-syntax')
+    request = {'id': 1, 'input': str(tmp_path / 'main.sbnf'), 'output': output}
+
+    assert _request(server, request)['written'] is True
+    assert _request(server, request)['written'] is False
+    (tmp_path / 'lib.sbnf').write_text('word : `b`{b} ;\n')
+    assert _request(server, request)['written'] is True
+    with open(output) as f:
+        assert 'b.main' in f.read()
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='needs Unix sockets')
+def test_serves_unix_socket(tmp_path):
+    path = str(tmp_path / 'server.sock')
+    env = dict(os.environ, SUBLIME_FROM_CFG_CACHE_DIR='')
+    process = subprocess.Popen(
+        SERVE + ['--socket', path], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + TIMEOUT
+        while not os.path.exists(path):
+            assert process.poll() is None and time.monotonic() < deadline
+            time.sleep(0.05)
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(path)
+            stream = client.makefile('rw')
+            for i in range(2):
+                stream.write(json.dumps({'id': i, 'text': 'main : `a`{a} ;', 'name': 'sock'}) + '\n')
+                stream.flush()
+                response = json.loads(stream.readline())
+                assert response['id'] == i and 'a.sock' in response['syntax']
+    finally:
+        process.kill()
+        process.wait()
@@ -0,0 +1,68 @@
+"""
+Checks that factoring regexes out into `variables` doesn't change any
+pattern: substituting the variables back, as Sublime Text does, gives the
+patterns the generator made.
+"""
+import glob
+import json
+import os
+import re
+
+import pytest
+from ruamel.yaml import YAML
+
+from sublime_from_cfg import sublime_from_cfg
+from sublime_from_cfg.contexts import to_yaml
+from sublime_from_cfg.types import SublimeSyntaxOptions
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GRAMMARS = sorted(
+    os.path.relpath(path, ROOT)
+    for pattern in ('tests/*/*.sbnf', 'sbnf/*.sbnf')
+    for path in glob.glob(os.path.join(ROOT, pattern))
+)
+
+
+@pytest.fixture(autouse=True)
+def no_disk_cache(monkeypatch):
+    monkeypatch.setenv('SUBLIME_FROM_CFG_CACHE_DIR', '')
+
+
+def _substitute(entry, variables):
+    entry = dict(entry)
+    if 'match' in entry:
+        entry['match'] = re.sub(
+            r'\{\{(\w+)\}\}', lambda m: variables[m.group(1)], entry['match'])
+    if 'with_prototype' in entry:
+        entry['with_prototype'] = [_substitute(e, variables) for e in entry['with_prototype']]
+    return entry
+
+
+def _plain(contexts):
+    return json.loads(json.dumps(contexts))
+
+
+@pytest.mark.parametrize('path', GRAMMARS)
+def test_variables_substitute_back(path):
+    with open(os.path.join(ROOT, path)) as f:
+        text = f.read()
+    name = os.path.basename(path)[:-len('.sbnf')]
+    syntax = sublime_from_cfg(
+        text, [], SublimeSyntaxOptions(name), path=os.path.join(ROOT, path))
+
+    dumped = YAML(typ='safe', pure=True).load(syntax.dump())
+    variables = dumped.get('variables', {})
+    assert not any('{{' in regex for regex in variables.values())
+    substituted = {
+        context: [_substitute(entry, variables) for entry in entries]
+        for context, entries in dumped['contexts'].items()
+    }
+    assert _plain(substituted) == _plain(to_yaml(syntax.contexts))
+
+
+def test_variables_are_used():
+    with open(os.path.join(ROOT, 'sbnf', 'sbnf.sbnf')) as f:
+        syntax = sublime_from_cfg(f.read(), [], SublimeSyntaxOptions('sbnf'))
+    assert YAML(typ='safe', pure=True).load(syntax.dump())['variables']
@@ -0,0 +1,29 @@
+"""
+Tests of `write_if_changed`, which must rewrite any file whose bytes differ.
+"""
+from sublime_from_cfg import write_if_changed
+
+
+TEXT = 'name: x\ncontexts: {}\n'
+
+
+def test_writes_new_and_changed_files(tmp_path):
+    path = tmp_path / 'x.sublime-syntax'
+    assert write_if_changed(path, TEXT) is True
+    assert write_if_changed(path, TEXT) is False
+    assert write_if_changed(path, TEXT + '\n') is True
+    assert path.read_bytes() == (TEXT + '\n').encode()
+
+
+def test_rewrites_crlf_copies(tmp_path):
+    path = tmp_path / 'x.sublime-syntax'
+    path.write_bytes(TEXT.replace('\n', '\r\n').encode())
+    assert write_if_changed(path, TEXT) is True
+    assert path.read_bytes() == TEXT.encode()
+
+
+def test_rewrites_invalid_utf8(tmp_path):
+    path = tmp_path / 'x.sublime-syntax'
+    path.write_bytes(b'\xff\xfe')
+    assert write_if_changed(path, TEXT) is True
+    assert path.read_bytes() == TEXT.encode()